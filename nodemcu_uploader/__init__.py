@@ -6,3 +6,4 @@
 
 from .version import __version__  # noqa: F401
 from .uploader import Uploader  # noqa: F401
+from .aio import AsyncUploader  # noqa: F401
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""asyncio version of the Uploader.
+
+It runs the same flows of core.UploaderCore as the Uploader, but every wait
+for the device gives the event loop a chance to serve other devices. One
+process can drive many boards without a thread per port::
+
+    async def flash(port):
+        uploader = await AsyncUploader.connect(port)
+        try:
+            await uploader.prepare()
+            await uploader.write_file('init.lua')
+        finally:
+            await uploader.close()
+
+    loop.run_until_complete(asyncio.gather(*[flash(port) for port in ports]))
+"""
+
+import asyncio
+import logging
+import functools
+import serial
+
+from .serialutils import AsyncTransport
+from .batch import Batch
+from .core import UploaderCore, Write, Read, ReadUntil, Sleep, SetBaudrate, Clear
+
+
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+__all__ = ['AsyncUploader']
+
+
+def _coroutine(flow):
+    """The method of AsyncUploader that runs flow, of UploaderCore, to the end"""
+    @functools.wraps(flow)
+    async def method(self, *args, **kwargs):
+        return await self._run(flow(self, *args, **kwargs))
+    return method
+
+
+class AsyncUploader(UploaderCore):
+    """Like Uploader but every method talking to the device is a coroutine.
+    Create it with 'await AsyncUploader.connect(port)'.
+    """
+
+    def __init__(self, port, transport, baud=UploaderCore.BAUD, start_baud=UploaderCore.START_BAUD,
+                 timeout=UploaderCore.TIMEOUT, autobaud_time=UploaderCore.AUTOBAUD_TIME, window=UploaderCore.WINDOW):
+        super(AsyncUploader, self).__init__(port.port, baud, start_baud, timeout, autobaud_time, window)
+        self._port = port
+        self._transport = transport
+
+    @classmethod
+    async def connect(cls, port=UploaderCore.PORT, baud=UploaderCore.BAUD, start_baud=UploaderCore.START_BAUD,
+                      timeout=UploaderCore.TIMEOUT, autobaud_time=UploaderCore.AUTOBAUD_TIME,
+                      window=UploaderCore.WINDOW):
+        """Opens the port and gets in sync with the device"""
+        log.info('opening port %s with %s baud', port, start_baud)
+        if '://' in port:
+            ser = serial.serial_for_url(port, start_baud, timeout=0)
+        else:
+            ser = serial.Serial(port, start_baud, timeout=0)
+        uploader = cls(ser, AsyncTransport(ser), baud, start_baud, timeout, autobaud_time, window)
+        # RTS = CH_PD (i.e reset)
+        # DTR = GPIO0
+        try:
+            ser.setRTS(False)
+            ser.setDTR(False)
+        except (OSError, serial.SerialException):
+            log.debug('port has no RTS/DTR')
+        try:
+            await uploader._run(uploader._connect())
+        except Exception:
+            uploader._transport.close()
+            ser.close()
+            raise
+        return uploader
+
+    async def _run(self, flow):
+        """Runs flow to the end, doing what it asks for with the port, see Uploader"""
+        result, error = None, None
+        while True:
+            try:
+                request = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await self._do(request), None
+            except BaseException as e:
+                result, error = None, e
+
+    async def _do(self, request):
+        """Does one request of a flow, see core"""
+        if isinstance(request, Read):
+            return await self._transport.read(request.size, request.timeout)
+        if isinstance(request, ReadUntil):
+            return await self._transport.read_until(request.expected, request.timeout)
+        if isinstance(request, Write):
+            await self._transport.write(request.data)
+        elif isinstance(request, Sleep):
+            await asyncio.sleep(request.seconds)
+        elif isinstance(request, SetBaudrate):
+            self._port.baudrate = request.baud
+        elif isinstance(request, Clear):
+            self._port.reset_input_buffer()
+            self._port.reset_output_buffer()
+            self._transport.clear()
+        else:
+            raise TypeError('Unknown request {0!r}'.format(request))
+
+    async def close(self):
+        """restores the nodemcu to default baudrate and then closes the port"""
+        try:
+            await self._run(self._restore())
+        except serial.serialutil.SerialException:
+            pass
+        log.debug('closing port')
+        self._transport.close()
+        self._port.close()
+
+    def batch(self):
+        """A Batch of remote operations, run it with 'await run_batch(batch)'"""
+        return Batch()
+
+    auto_baud = _coroutine(UploaderCore._auto_baud)
+    prepare = _coroutine(UploaderCore._prepare)
+    download_file = _coroutine(UploaderCore._download_file)
+    read_file = _coroutine(UploaderCore._read_file)
+    write_file = _coroutine(UploaderCore._write_file)
+    verify_file = _coroutine(UploaderCore._verify_file)
+    exec_file = _coroutine(UploaderCore._exec_file)
+    write_lines = _coroutine(UploaderCore._write_lines)
+    exec_block = _coroutine(UploaderCore._exec_block)
+    query = _coroutine(UploaderCore._query)
+    file_list = _coroutine(UploaderCore._file_list)
+    device_id = _coroutine(UploaderCore._device_id)
+    load_manifest = _coroutine(UploaderCore._load_manifest)
+    remote_state = _coroutine(UploaderCore._remote_state)
+    file_hashes = _coroutine(UploaderCore._file_hashes)
+    file_do = _coroutine(UploaderCore._file_do)
+    file_format = _coroutine(UploaderCore._file_format)
+    file_print = _coroutine(UploaderCore._file_print)
+    file_remove_all = _coroutine(UploaderCore._file_remove_all)
+    node_heap = _coroutine(UploaderCore._node_heap)
+    node_restart = _coroutine(UploaderCore._node_restart)
+    node_info = _coroutine(UploaderCore._node_info)
+    node_info_group = _coroutine(UploaderCore._node_info_group)
+    file_compile = _coroutine(UploaderCore._file_compile)
+    file_remove = _coroutine(UploaderCore._file_remove)
+    run_batch = _coroutine(UploaderCore._run_batch)
+    backup = _coroutine(UploaderCore._backup)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Remote operations that are sent to the device together.
+
+    with uploader.batch() as batch:
+        batch.file_compile('main.lua')
+        batch.file_remove('main.lua')
+        batch.file_do('main.lc')
+    for result in batch.results:
+        ...
+
+Every operation runs protected by pcall, so one that fails doesn't stop the
+ones after it, and prints a marker when it is done. One exchange, or a few
+for very long batches, returns the output and error of each of them.
+"""
+
+from collections import namedtuple
+
+from .luacode import BATCH_STATEMENT, PRINT_FILE
+
+__all__ = ['Batch', 'BatchResult', 'parse_batch']
+
+# what BATCH_STATEMENT prints after the output of the statement
+DONE = '\x05'
+FAILED = '\x15'
+
+# output is what the operation printed, error is None if it didn't fail
+BatchResult = namedtuple('BatchResult', ['output', 'error'])
+
+# kind is the name of the Uploader method that does the same, target its argument
+Operation = namedtuple('Operation', ['kind', 'target', 'code'])
+
+# for the log
+VERBS = {'code': 'Run', 'file_remove': 'Remove', 'file_compile': 'Compile', 'file_do': 'Executing',
+         'file_print': 'Printing'}
+
+
+def describe(op):
+    return '{0} {1}'.format(VERBS[op.kind], op.code if op.target is None else op.target)
+
+
+def batch_code(operations):
+    """The Lua chunk that runs operations"""
+    return '\n'.join(BATCH_STATEMENT.format(code=op.code) for op in operations)
+
+
+def parse_batch(res, count):
+    """Splits what batch_code() printed into a BatchResult per operation.
+    Operations that never ran, because the chunk failed, get its error."""
+    results = []
+    output = []
+    for line in res.split('\r\n'):
+        # the marker ends up after output that didn't end the line
+        failed = line.find(FAILED)
+        if line.endswith(DONE) or failed != -1:
+            line, error = (line[:-1], None) if line.endswith(DONE) else (line[:failed], line[failed + 1:])
+            if line:
+                output.append(line)
+            results.append(BatchResult('\r\n'.join(output), error))
+            output = []
+        else:
+            output.append(line)
+    rest = '\r\n'.join(output).strip()
+    while len(results) < count:
+        results.append(BatchResult('', rest or 'not run'))
+    return results
+
+
+class Batch(object):
+    """Queues remote operations until run by Uploader.run_batch(), or at the
+    end of the with block. Their results are then in self.results, a
+    BatchResult per operation in the same order."""
+
+    def __init__(self, runner=None):
+        self.operations = []
+        self.results = None
+        self._runner = runner
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self._runner is not None:
+            self.results = self._runner(self)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def _add(self, kind, target, code):
+        self.operations.append(Operation(kind, target, code))
+        return self
+
+    def code(self, code):
+        """Any Lua statements"""
+        return self._add('code', None, code)
+
+    def file_remove(self, path):
+        return self._add('file_remove', path, 'file.remove("%s")' % path)
+
+    def file_compile(self, path):
+        return self._add('file_compile', path, 'node.compile("%s")' % path)
+
+    def file_do(self, path):
+        return self._add('file_do', path, 'dofile("%s")' % path)
+
+    def file_print(self, path):
+        return self._add('file_print', path, PRINT_FILE.format(filename=path))
+
+    def split(self, size):
+        """The operations in groups whose code is at most size bytes, or one operation"""
+        groups = []
+        group = []
+        length = 0
+        for op in self.operations:
+            code = len(BATCH_STATEMENT.format(code=op.code)) + 1
+            if group and length + code > size:
+                groups.append(group)
+                group = []
+                length = 0
+            group.append(op)
+            length += code
+        if group:
+            groups.append(group)
+        return groups
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Host side cache of the baudrates of devices"""
+
+import json
+import os
+
+from .utils import cache_dir, write_json
+
+__all__ = ['BaudCache']
+
+
+class BaudCache(object):
+    """Baudrates kept between runs in one json file. The highest rate that
+    passed the probe for each pair of serial adapter and board, and the rate
+    that the device on each port was last left at.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'bauds.json')
+        self.bauds = {}
+        self.ports = {}
+        self.load()
+
+    @staticmethod
+    def key(adapter, board):
+        return '{0} {1}'.format(adapter, board)
+
+    def load(self):
+        """Read the cache from disk, a missing or broken file is an empty cache"""
+        try:
+            with open(self.path, 'r') as fil:
+                data = json.load(fil)
+            self.bauds = dict(data.get('best', {}))
+            self.ports = dict(data.get('last', {}))
+        except (IOError, OSError, AttributeError, TypeError, ValueError):
+            self.bauds = {}
+            self.ports = {}
+
+    def get(self, adapter, board):
+        """The remembered baudrate, None if there is none"""
+        return self.bauds.get(self.key(adapter, board))
+
+    def set(self, adapter, board, baud):
+        """Remember baud and write the cache to disk"""
+        self.load()
+        self.bauds[self.key(adapter, board)] = baud
+        self.save()
+
+    def last(self, port):
+        """The rate the device on port was left at, None if not known"""
+        return self.ports.get(port)
+
+    def set_last(self, port, baud):
+        """Remember the rate of the device on port, the disk is only written if it changed"""
+        self.load()
+        if self.ports.get(port) != baud:
+            self.ports[port] = baud
+            self.save()
+
+    def save(self):
+        """Write the cache to disk. Call load() first to keep what other
+        processes have written in the meantime."""
+        write_json(self.path, {'best': self.bauds, 'last': self.ports})
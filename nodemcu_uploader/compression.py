@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""A small LZ77 variant that is cheap to expand in Lua on the device.
+
+Every block is compressed on its own and is a sequence of tokens
+  0xxxxxxx <x+1 literal bytes>
+  1xxxxxxx <offset hi> <offset lo>   copy x+4 bytes from offset bytes back
+which the inflate function in luacode.RECV_LUA expands with string.sub.
+"""
+
+import zlib
+
+__all__ = ['compress_block', 'decompress_block', 'worth_compressing']
+
+MIN_MATCH = 4
+MAX_MATCH = 127 + MIN_MATCH
+MAX_LITERALS = 128
+MAX_OFFSET = 0xffff
+# how many earlier positions to try for every match
+MAX_CHAIN = 16
+# a compressed block must be at most this share of the raw one, otherwise
+# expanding it on the device costs more than the bytes saved on the wire
+MAX_RATIO = 0.8
+
+
+def _literals(out, data):
+    for pos in range(0, len(data), MAX_LITERALS):
+        run = data[pos:pos + MAX_LITERALS]
+        out.append(len(run) - 1)
+        out += run
+
+
+def compress_block(data):
+    """Compress one block of bytes"""
+    out = bytearray()
+    chains = {}
+    size = len(data)
+    literal = 0
+    pos = 0
+    while pos < size:
+        best_len = 0
+        best_off = 0
+        if pos + MIN_MATCH <= size:
+            key = data[pos:pos + MIN_MATCH]
+            chain = chains.setdefault(key, [])
+            limit = min(MAX_MATCH, size - pos)
+            for start in reversed(chain[-MAX_CHAIN:]):
+                if pos - start > MAX_OFFSET:
+                    break
+                length = MIN_MATCH
+                while length < limit and data[start + length] == data[pos + length]:
+                    length += 1
+                if length > best_len:
+                    best_len = length
+                    best_off = pos - start
+                    if length == limit:
+                        break
+            chain.append(pos)
+        if best_len >= MIN_MATCH:
+            _literals(out, data[literal:pos])
+            out.append(0x80 + best_len - MIN_MATCH)
+            out += best_off.to_bytes(2, 'big')
+            for skipped in range(pos + 1, min(pos + best_len, size - MIN_MATCH + 1)):
+                chains.setdefault(data[skipped:skipped + MIN_MATCH], []).append(skipped)
+            pos += best_len
+            literal = pos
+        else:
+            pos += 1
+    _literals(out, data[literal:])
+    return bytes(out)
+
+
+def decompress_block(data):
+    """Expand one compressed block, the same way the device does it"""
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        head = data[pos]
+        if head < 0x80:
+            out += data[pos + 1:pos + head + 2]
+            pos += head + 2
+        else:
+            length = head - 0x80 + MIN_MATCH
+            start = len(out) - int.from_bytes(data[pos + 1:pos + 3], 'big')
+            # byte by byte since the copy may overlap what it produces
+            for i in range(length):
+                out.append(out[start + i])
+            pos += 3
+    return bytes(out)
+
+
+def worth_compressing(content):
+    """A quick guess if content compresses at all, so that already
+    compressed files like images don't waste time in compress_block"""
+    if len(content) == 0:
+        return False
+    return len(zlib.compress(content, 1)) < len(content) * MAX_RATIO
@@ -0,0 +1,1009 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""The protocol of the uploader, without the port.
+
+Everything that talks to the device is a flow, a generator method of
+UploaderCore that yields what it needs done with the port, one of the
+requests below, and gets the result back::
+
+    res = yield ReadUntil(b'> ', self._timeout)
+
+Uploader runs the flows blocking on a serial port and AsyncUploader in an
+event loop, so both speak the same protocol from the same code.
+"""
+
+import time
+import logging
+import hashlib
+import os
+from collections import namedtuple
+
+from . import validate
+from .serialutils import default_port, adapter_id
+from .exceptions import CommunicationTimeout, DeviceNotFoundException, \
+    BadResponseException, VerificationError, NoAckException
+from .utils import hexify, from_file, ENCODING
+from .manifest import Manifest, BackupManifest
+from .baudcache import BaudCache
+from .stats import Stats, recorded
+from .progress import notify, START, FRAME, END
+from .query import INFO_GROUPS, query_code, parse_query
+from .batch import Batch, batch_code, parse_batch, describe
+from .compression import compress_block, worth_compressing, MAX_RATIO
+from .minify import minify as minify_lua
+from .luacode import RECV_LUA, SEND_LUA, PROTOCOL_VERSION, PROTOCOL_INFO, CONNECT_PROBE, LOAD_CHUNK, CHUNK_DONE, \
+    UART_SETUP, BAUD_TRIAL, BAUD_CONFIRM, PRINT_FILE, \
+    REMOVE_ALL_FILES
+
+
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+__all__ = ['UploaderCore', 'Write', 'Read', 'ReadUntil', 'Sleep', 'SetBaudrate', 'Clear',
+           'file_content', 'BAUD_AUTO']
+
+
+# What a flow can ask for. The result sent back is None unless it says otherwise.
+# writes all of data and flushes the port
+Write = namedtuple('Write', ['data'])
+# bytes, see BufferedReader.read
+Read = namedtuple('Read', ['size', 'timeout'])
+# bytes, see BufferedReader.read_until
+ReadUntil = namedtuple('ReadUntil', ['expected', 'timeout'])
+Sleep = namedtuple('Sleep', ['seconds'])
+# of the port, the device is told by the flow
+SetBaudrate = namedtuple('SetBaudrate', ['baud'])
+# throws away whatever is buffered either way
+Clear = namedtuple('Clear', [])
+
+
+BLOCK_START = b'\x01'
+BLOCK_COMPRESSED = b'\x02'
+NUL = b'\x00'
+ACK = b'\x06'
+# sequence numbers are a single byte so keep well below half of that
+MAX_WINDOW = 64
+# block sizes that can be negotiated, the length field is 16 bits
+MIN_BLOCK_SIZE = 128
+MAX_BLOCK_SIZE = 4096
+# copies of a block the device holds while it receives one, see RECV_LUA: the pieces from
+# uart.on, the joined block and, for a compressed one, what inflate has made of it so far
+# and the joined output
+BLOCK_COPIES = 4
+# the copies that are done with are only freed when the garbage collector gets to them,
+# so the free heap has to allow for all of them twice
+BLOCK_HEAP_DIVISOR = BLOCK_COPIES * 2
+# baud='auto' steps up through these from start_baud
+BAUD_AUTO = 'auto'
+BAUD_CANDIDATES = (230400, 460800, 921600, 1500000)
+# milliseconds before the device goes back to the previous rate of a failed trial
+BAUD_REVERT = 1500
+# seconds to wait for an answer at a rate on trial
+PROBE_TIMEOUT = 1
+# where exec_block() keeps the code it runs
+EXEC_FILE = '_nmu_exec.lua'
+# seconds to wait for a live device to answer CONNECT_PROBE before the autobaud sequence
+CONNECT_TIMEOUT = 0.2
+# every printable character but the quote and backslash, flipped bits show
+BAUD_PROBE = ''.join(chr(c) for c in range(0x20, 0x7f) if chr(c) not in '"\\')
+
+
+def file_content(path, minify='none'):
+    """Returns the content of path as it should be uploaded.
+    Valid options for minify are 'none', 'basic' or 'locals' which also renames
+    local variables. Only .lua files are minified."""
+    if minify not in ('none', 'basic', 'locals'):
+        raise Exception(minify + ' is not a valid minify method.')
+    content = from_file(path)
+    if minify == 'none' or not path.endswith('.lua'):
+        return content
+    return minify_lua(content.decode(ENCODING), rename=minify == 'locals').encode(ENCODING)
+
+
+def block_size_for_heap(heap):
+    """Returns the largest power of two block size that the free heap allows"""
+    size = MIN_BLOCK_SIZE
+    while size * 2 <= MAX_BLOCK_SIZE and size * 2 <= heap // BLOCK_HEAP_DIVISOR:
+        size *= 2
+    return size
+
+
+# The parts of the protocol that need no state of the connection
+
+def probe_command():
+    return 'print("{0}")'.format(BAUD_PROBE)
+
+
+def probe_ok(res):
+    """True if res is exactly the echo and output of probe_command()"""
+    return res == '{0}\r\n{1}\r\n> '.format(probe_command(), BAUD_PROBE)
+
+
+def parse_protocol_info(res):
+    """Returns the free heap from the output of PROTOCOL_INFO or None if the
+    functions on the device are missing or of an other version"""
+    lines = [line.split('\t') for line in res.split('\r\n')]
+    info = [line for line in lines if len(line) == 2 and line[1].isdigit()]
+    if len(info) == 0 or info[-1][0] != str(PROTOCOL_VERSION):
+        log.debug('device has protocol version %s, wants %d', info and info[-1][0], PROTOCOL_VERSION)
+        return None
+    return int(info[-1][1])
+
+
+def split_blocks(content, block_size, compress=False):
+    """Splits content into the blocks to send. Returns the blocks and if each of
+    them is compressed. The last block is always the empty one that closes the file"""
+    blocks = [content[pos:pos+block_size] for pos in range(0, len(content), block_size)]
+    blocks.append(bytes())
+    compressed = [False] * len(blocks)
+    if compress and worth_compressing(content):
+        for i, block in enumerate(blocks[:-1]):
+            packed = compress_block(block)
+            if len(packed) <= len(block) * MAX_RATIO:
+                blocks[i] = packed
+                compressed[i] = True
+        log.debug('compressed %d of %d blocks', sum(compressed), len(blocks) - 1)
+    return blocks, compressed
+
+
+def frame(seq, chunk, compressed=False):
+    """A block as it is sent to recv() on the device"""
+    if not isinstance(chunk, bytes):
+        raise TypeError()
+    start = BLOCK_COMPRESSED if compressed else BLOCK_START
+    return start + bytes([seq]) + len(chunk).to_bytes(2, 'big') + chunk
+
+
+def acked_count(seq, acked, sent):
+    """How many more blocks an ACK of seq covers, when 'acked' of 'sent' were
+    acked before. An ACK for a block also covers all blocks before it.
+    Returns 0 if seq is None or not one of the blocks in flight"""
+    count = (seq - acked) % 256 + 1 if seq is not None else 0
+    if count < 1 or count > sent - acked:
+        return 0
+    return count
+
+
+def chunk_size(head):
+    """Size of the data in a block sent by send() on the device, from its 3 byte header"""
+    if len(head) < 3 or head[:1] != BLOCK_START:
+        log.debug('buffer binary: %s ', hexify(head))
+        raise Exception('Bad blocksize or start byte')
+    size = int.from_bytes(head[1:3], 'big')
+    if size > MAX_BLOCK_SIZE:
+        raise Exception('Bad blocksize or start byte')
+    return size
+
+
+def format_file_list(files):
+    """[name, size] of each file from the files of a query"""
+    return [[name, str(size)] for name, size in files.items()]
+
+
+def format_info(state):
+    """The info groups of a query as lines of key and value"""
+    lines = []
+    for group in INFO_GROUPS:
+        for key, value in state.get(group, {}).items():
+            value = str(value).lower() if isinstance(value, bool) else value
+            lines.append('{0:20s}\t{1}'.format(key, value))
+    return '\r\n'.join(lines)
+
+
+def format_file_hashes(hashes):
+    """{name: (size, sha1)} from the hashes of a query"""
+    return dict((name, (entry['size'], entry['sha1'])) for name, entry in hashes.items())
+
+
+def parse_prefix(res):
+    """(size, sha1) from the output of prefix() on the device, or None if
+    the file is missing or the device can't hash it"""
+    for line in res.split('\r\n'):
+        fields = line.split('\t')
+        if len(fields) == 2 and fields[0].isdigit() and len(fields[1]) == 40:
+            return int(fields[0]), fields[1]
+    return None
+
+
+def check_sha1(remote, local):
+    """Raises VerificationError unless the SHA1 of a file on the device is that of the local content"""
+    log.info('Remote SHA1: %s', remote)
+    log.info('Local SHA1: %s', local)
+    if remote != local:
+        log.error('SHA1 verification failed.')
+        raise VerificationError('SHA1 Verification failed.')
+    log.info('Verification successful. Checksums match')
+
+
+def backed_up(path, name, entry, manifest):
+    """True if the backup in path has the file name with the (size, sha1) of entry"""
+    local = os.path.join(path, name)
+    return manifest.get(name) == entry and os.path.isfile(local) and os.path.getsize(local) == entry[0]
+
+
+def file_sizes(files):
+    """{name: size} from the output of file_list()"""
+    return dict((entry[0], int(entry[1])) for entry in files if len(entry) == 2 and entry[1].isdigit())
+
+
+class UploaderCore(object):
+    """The state of a connection to the nodemcu and the flows of everything
+    Uploader and AsyncUploader can do with it. The flows of the public methods
+    have their name with an underscore in front.
+    """
+    BAUD = 115200
+    START_BAUD = 115200
+    TIMEOUT = 5
+    AUTOBAUD_TIME = 0.3
+    WINDOW = 1
+    PORT = default_port()
+
+    def __init__(self, port, baud, start_baud, timeout, autobaud_time, window):
+        self.set_timeout(timeout)
+        self.window = window
+        # until prepare() has negotiated something larger
+        self.block_size = MIN_BLOCK_SIZE
+        # what files the device has, see load_manifest()
+        self.manifest = None
+        self.stats = Stats()
+        # called with the progress of transfers, see progress
+        self.listeners = []
+        self.start_baud = start_baud
+        self.baud = baud
+        self.autobaud_time = autobaud_time
+        self.line_number = 0
+        self._port_name = port
+        # True when the probe found the helpers of prepare()
+        self._helpers = False
+        # a device that is live at the rate it was left at needs no autobaud sequence
+        self._bauds = BaudCache()
+
+    def _connect(self):
+        """Gets in sync with the device, which is assumed to be at start_baud
+        or the rate it was left at, and switches to self.baud"""
+        wanted = self.baud
+        current = self._bauds.last(self._port_name) or self.start_baud
+        if current != self.start_baud:
+            yield SetBaudrate(current)
+        if not (yield from self._probe()):
+            if current != self.start_baud:
+                yield SetBaudrate(self.start_baud)
+                current = self.start_baud
+            yield from self._sync()
+
+        self.baud = current
+        if wanted == BAUD_AUTO:
+            self.baud = yield from self._auto_baud()
+        elif wanted != current:
+            yield from self._set_baudrate(wanted)
+            self.baud = wanted
+
+            # Get in sync again
+            if not (yield from self._probe()):
+                yield from self._sync()
+        self._left_at(self.baud)
+
+    def _restore(self):
+        """Puts the nodemcu back at the default baudrate before the port is closed"""
+        if self.baud != self.start_baud:
+            yield from self._set_baudrate(self.start_baud)
+            self._left_at(self.start_baud)
+        yield Clear()
+
+    def _left_at(self, baud):
+        """Remembers the rate of the device for the next connection"""
+        if baud != (self._bauds.last(self._port_name) or self.start_baud):
+            self._bauds.set_last(self._port_name, baud)
+
+    def _probe(self):
+        """Checks quickly if the device is at a prompt at the current baudrate.
+        The same exchange finds the helpers of prepare(), if they are there."""
+        log.debug('probing for a live device')
+        yield Clear()
+        try:
+            yield from self._writeln(CONNECT_PROBE)
+            res = yield from self._expect('%sync%\r\n> ', CONNECT_TIMEOUT)
+        except CommunicationTimeout:
+            return False
+        self._helpers = self._negotiate(res)
+        return True
+
+    def _sync(self):
+        """Get in sync with LUA (this assumes that NodeMCU gets reset by the driver)"""
+        log.debug('getting in sync with LUA')
+        yield Clear()
+        try:
+            yield from self._writeln('UUUUUUUUUUUU')  # Send enough characters for auto-baud
+            yield Clear()
+            yield Sleep(self.autobaud_time)  # Wait for autobaud timer to expire
+            yield from self._exchange(';')  # Get a defined state
+            yield from self._writeln('print("%sync%");')
+            yield from self._expect('%sync%\r\n> ')
+        except CommunicationTimeout:
+            raise DeviceNotFoundException('Device not found or wrong port')
+
+    def _set_baudrate(self, baud):
+        """setting baudrate if supported"""
+        log.info('Changing communication to %s baud', baud)
+        yield from self._writeln(UART_SETUP.format(baud=baud))
+        # Wait for the string to be sent before switching baud
+        yield Sleep(0.1)
+        yield SetBaudrate(baud)
+
+    @recorded
+    def _auto_baud(self, candidates=BAUD_CANDIDATES, cache=None):
+        """Steps up from the current baudrate through candidates and stays at the
+        highest rate that passes a probe. The rate is remembered for the adapter
+        and the board and tried first the next time. Returns the rate."""
+        cache = cache or BaudCache()
+        adapter = adapter_id(self._port_name)
+        board = yield from self._device_id()
+        baud = self.baud
+        known = cache.get(adapter, board)
+        if known == baud or (known and (yield from self._try_baud(known, baud))):
+            log.info('Using %s baud that worked before', known)
+            return known
+        for candidate in sorted(c for c in candidates if c > baud):
+            if not (yield from self._try_baud(candidate, baud)):
+                break
+            baud = candidate
+        log.info('Settled on %s baud', baud)
+        cache.set(adapter, board, baud)
+        return baud
+
+    def _try_baud(self, baud, fallback):
+        """Switches to baud with a timer on the device that goes back to fallback
+        unless the probe passes in time. Returns False, at fallback, if it didn't."""
+        log.info('Trying %s baud', baud)
+        yield from self._writeln(BAUD_TRIAL.format(baud=baud, fallback=fallback, time=BAUD_REVERT))
+        # Wait for the string to be sent before switching baud
+        yield Sleep(0.1)
+        reverted = time.time() + BAUD_REVERT / 1000.0 + 0.1
+        yield SetBaudrate(baud)
+        try:
+            yield Clear()
+            yield from self._exchange(';', PROBE_TIMEOUT)
+            if probe_ok((yield from self._exchange(probe_command(), PROBE_TIMEOUT))):
+                yield from self._exchange(BAUD_CONFIRM, PROBE_TIMEOUT)
+                return True
+            self.stats.bad_response()
+        except CommunicationTimeout:
+            pass
+        log.info('%s baud failed, back to %s', baud, fallback)
+        yield SetBaudrate(fallback)
+        yield Sleep(max(0, reverted - time.time()))
+        yield from self._sync()
+        return False
+
+    def set_timeout(self, timeout):
+        """Set the timeout for the communication with the device."""
+        timeout = int(timeout)  # will raise on Error
+        self._timeout = timeout == 0 and 999999 or timeout
+
+    def _expect(self, exp='> ', timeout=None):
+        """will wait for exp to be returned from nodemcu or timeout.
+        Will use utils.ENCODING for encoding if not bytes.
+        """
+        timeout = timeout or self._timeout
+
+        if not isinstance(exp, bytes):
+            exp = bytes(exp, ENCODING)
+
+        # Finish as soon as either exp matches or we run out of time
+        start = time.time()
+        data = yield ReadUntil(exp, timeout)
+        self.stats.wait('expect', time.time() - start)
+        self.stats.read(len(data))
+        log.debug('expect returned: `{0}`. wants: {1}'.format(data, exp))
+
+        if not data.endswith(exp) and len(exp) > 0:
+            self.stats.timeout()
+            raise CommunicationTimeout('Timeout waiting for data', data)
+
+        return str(data, ENCODING)
+
+    def _write(self, output, binary=False):
+        """write data on the nodemcu port. Strings will be converted to bytes using utils.ENCODING.
+        If 'binary' is True the debug log will show the intended output as hex, otherwise as string"""
+        if not binary:
+            log.debug('write: %s', output)
+        else:
+            log.debug('write binary: %s', hexify(output))
+        if isinstance(output, str):
+            output = bytes(output, ENCODING)
+
+        self.stats.written(len(output))
+        yield Write(output)
+
+    def _writeln(self, output):
+        """write, with linefeed"""
+        yield from self._write(output + '\n')
+
+    def _exchange(self, output, timeout=None):
+        """Write output to the port and wait for response
+        Expects a str as input"""
+        if not isinstance(output, str):
+            raise TypeError("output should be a str")
+        yield from self._writeln(output)
+        return (yield from self._expect(timeout=timeout or self._timeout))
+
+    @recorded
+    def _prepare(self):
+        """
+        This uploads the protocol functions nessecary to do binary
+        chunked transfer
+        """
+        log.info('Preparing esp for transfer.')
+
+        if self._helpers or self._negotiate((yield from self._exchange(PROTOCOL_INFO))):
+            log.info('Preparation already done. Not adding functions again.')
+            self._helpers = True
+            return True
+        # as few bytes as possible, and everything in one chunk
+        functions = minify_lua(RECV_LUA + '\n' + SEND_LUA, rename=True)
+        resp = yield from self._exec_chunk(functions + '\n' + PROTOCOL_INFO)
+        if not self._negotiate(resp):
+            log.error('error when preparing "%s"', resp)
+            return False
+        self._helpers = True
+        return True
+
+    def _negotiate(self, res):
+        """Checks the protocol version of the functions on the device from the
+        output of PROTOCOL_INFO and picks a block size from the free heap.
+        Returns False if the functions are missing or of an other version"""
+        heap = parse_protocol_info(res)
+        if heap is None:
+            return False
+        self.block_size = block_size_for_heap(heap)
+        log.info('Using %d byte blocks', self.block_size)
+        return True
+
+    def _exec_chunk(self, code, timeout=None):
+        """Runs code on the device as one chunk. There is no line length limit
+        and no prompt to wait for per line. Returns what the code printed"""
+        data = bytes(code, ENCODING)
+        yield from self._exchange(LOAD_CHUNK.format(size=len(data)))
+        yield from self._write(data, True)
+        res = yield from self._expect(CHUNK_DONE, timeout)
+        return res[:-len(CHUNK_DONE)]
+
+    @recorded
+    def _download_file(self, filename, sink=None, size=None, offset=0):
+        """Download a file from device, from 'offset' on.
+        If 'sink' is given every chunk is written to it as it arrives and the number
+        of bytes is returned, otherwise 'bytes' of the full content is returned.
+        'size', if known, is only used for the progress.
+        """
+        validate.remotePath(filename)
+        res = yield from self._exchange('send("{filename}", {size}, {offset})'.format(
+            filename=filename, size=self.block_size, offset=offset))
+        if ('unexpected' in res) or ('stdin' in res):
+            log.error('Unexpected error downloading file: %s', res)
+            raise Exception('Unexpected error downloading file')
+
+        # tell device we are ready to receive
+        yield from self._write('C')
+        # we should get a NUL terminated filename to start with
+        sent_filename = (yield from self._expect(NUL)).strip()
+        log.info('receiveing ' + sent_filename)
+
+        # ACK to start download
+        yield from self._write(ACK, True)
+        start = time.time()
+        if self.listeners:
+            notify(self.listeners, START, 'download_file', filename, offset, size, start)
+
+        data = bytearray()
+        done = 0
+        chunk = yield from self._read_chunk()
+        # read chunks until we get an empty which is the end
+        while len(chunk) > 0:
+            yield from self._write(ACK, True)
+            self.stats.payload(len(chunk), 1)
+            if sink is None:
+                data += chunk
+            else:
+                sink.write(chunk)
+            done += len(chunk)
+            if self.listeners:
+                notify(self.listeners, FRAME, 'download_file', filename, offset + done, size, start)
+            chunk = yield from self._read_chunk()
+        # send() prints this after the last block, it is not an answer to what comes next
+        yield from self._expect('interrupted\r\n')
+        if self.listeners:
+            notify(self.listeners, END, 'download_file', filename, offset + done, offset + done, start)
+        if sink is None:
+            return bytes(data)
+        return done
+
+    def _read_file(self, filename, destination='', size=None, resume=False):
+        """Downloading data from remote device into local file using the transfer protocol.
+        The file is written as the data arrives, next to destination until the
+        download is complete. With 'resume' a destination that is the start of
+        the file on the device is only completed, in place.
+        """
+        if not destination:
+            destination = filename
+        log.info('Transferring %s to %s', filename, destination)
+
+        # Just in case, the filename may contain folder, so create it if needed.
+        dirpath = os.path.dirname(destination)
+        if len(dirpath) > 0:
+            os.makedirs(dirpath, exist_ok=True)
+        offset = (yield from self._download_offset(filename, destination)) if resume else 0
+        if offset:
+            with open(destination, 'ab') as fil:
+                return (yield from self._download_file(filename, fil, size, offset))
+        # a failed download leaves what was there before
+        part = destination + '.part'
+        try:
+            with open(part, 'wb') as fil:
+                done = yield from self._download_file(filename, fil, size)
+        except BaseException:
+            os.remove(part)
+            raise
+        os.replace(part, destination)
+        return done
+
+    def _prefix(self, filename, count=None):
+        """(size, sha1 of the first count bytes) of the file on the device, see parse_prefix()"""
+        count = '' if count is None else ', {0}'.format(count)
+        return parse_prefix((yield from self._exchange('prefix("{0}"{1})'.format(filename, count))))
+
+    def _download_offset(self, filename, destination):
+        """Where to resume downloading filename to destination, 0 to start over"""
+        if not os.path.isfile(destination):
+            return 0
+        local = from_file(destination)
+        remote = yield from self._prefix(filename, len(local))
+        if remote is None or remote[0] < len(local) or remote[1] != hashlib.sha1(local).hexdigest():
+            log.info('%s is not the start of %s, starting over', destination, filename)
+            return 0
+        log.info('Resuming %s at %d of %d bytes', filename, len(local), remote[0])
+        return len(local)
+
+    def _upload_offset(self, content, destination):
+        """Where to resume uploading content to destination, None if what is
+        on the device is not the start of it"""
+        remote = yield from self._prefix(destination)
+        if remote is None or remote[0] > len(content) or remote[1] != hashlib.sha1(content[:remote[0]]).hexdigest():
+            log.info('%s on the device is not the start of the upload, starting over', destination)
+            return None
+        log.info('Resuming %s at %d of %d bytes', destination, remote[0], len(content))
+        return remote[0]
+
+    @recorded
+    def _write_file(self, path, destination='', verify='none', window=None, compress=False, minify='none',
+                    resume=False):
+        """Uploads a file to the remote device using the transfer protocol.
+        Up to 'window' blocks are sent before waiting for the device to ACK them.
+        With 'compress' blocks are sent compressed when that saves enough to be worth
+        expanding them on the device. Lua files are minified according to 'minify',
+        see file_content(). The device hashes what it writes, so verify 'sha1'
+        needs no more than the transfer itself. With 'resume' a file on the
+        device that is the start of this one is only completed."""
+        filename = os.path.basename(path)
+        if not destination:
+            destination = filename
+        log.info('Transferring %s as %s', path, destination)
+        content = file_content(path, minify)
+        sha1 = hashlib.sha1(content).hexdigest()
+        offset = (yield from self._upload_offset(content, destination)) if resume else None
+        try:
+            if offset == len(content):
+                log.info('%s is complete on the device already', destination)
+                # the SHA1 of all of it was just compared
+                digest, sent = sha1, sha1
+            else:
+                offset = offset or 0
+                digest = yield from self._send(content, destination, window, compress, offset)
+                # the device only hashes what it appended, the start was compared before
+                sent = hashlib.sha1(content[offset:]).hexdigest() if offset else sha1
+
+            if verify == 'sha1' and digest is not None:
+                log.info('Verifying using the SHA1 of the transfer...')
+                check_sha1(digest, sent)
+            elif verify != 'none':
+                yield from self._verify_file(path, destination, verify, minify)
+        except BaseException:
+            if self.manifest is not None:
+                # the file may be there, but what it holds is not known
+                self.manifest.update(destination)
+                self.manifest.save()
+            raise
+
+        if self.manifest is not None:
+            self.manifest.update(destination, len(content), sha1)
+            self.manifest.save()
+
+    def _send(self, content, destination, window=None, compress=False, offset=0):
+        """Writes content to the file destination on the device, see write_file(),
+        or appends what comes after offset. Returns the SHA1 of what the device
+        wrote, or None if it can't hash"""
+        window = window or self.window
+        if window < 1 or window > MAX_WINDOW:
+            raise ValueError('window must be between 1 and {0}'.format(MAX_WINDOW))
+
+        validate.remotePath(destination)
+        yield from self._writeln('recv(true)' if offset else 'recv()')
+
+        res = yield from self._expect('C> ')
+        if not res.endswith('C> '):
+            log.error('Error waiting for esp "%s"', res)
+            raise CommunicationTimeout('Error waiting for device to start receiving', res)
+
+        log.debug('sending destination filename "%s"', destination)
+        yield from self._write(destination + '\x00', True)
+        if not (yield from self._got_ack()):
+            self.stats.bad_response()
+            log.error('did not ack destination filename')
+            raise NoAckException('Device did not ACK destination filename')
+
+        log.debug('sending %d bytes in %s with window %d', len(content) - offset, destination, window)
+        blocks, compressed = split_blocks(content[offset:], self.block_size, compress)
+        start = time.time()
+        if self.listeners:
+            notify(self.listeners, START, 'write_file', destination, offset, len(content), start)
+        sent = 0
+        acked = 0
+        while acked < len(blocks):
+            while sent < len(blocks) and sent - acked < window:
+                if len(blocks[sent]) == 0:
+                    log.debug('sending zero block')
+                yield from self._write_chunk(sent % 256, blocks[sent], compressed[sent])
+                sent += 1
+            count = acked_count((yield from self._got_ack(True)), acked, sent)
+            if count == 0:
+                self.stats.bad_response()
+                resp = yield from self._expect()
+                log.error('Bad chunk response "%s" %s', resp, hexify(resp))
+                raise BadResponseException('Bad chunk response', ACK, resp)
+            acked += count
+            if self.listeners:
+                done = min(offset + acked * self.block_size, len(content))
+                notify(self.listeners, FRAME, 'write_file', destination, done, len(content), start)
+        digest = yield from self._got_digest()
+        self.stats.payload(len(content) - offset, len(blocks))
+        if self.listeners:
+            notify(self.listeners, END, 'write_file', destination, len(content), len(content), start)
+        return digest
+
+    @recorded
+    def _verify_file(self, local, remote, verify='none', minify='none'):
+        """Tries to verify if local has same checksum as remote.
+            Valid options for verify is 'raw', 'sha1' or 'none'
+            and minify should be the same as when it was written.
+        """
+        # get the local file contents
+        yield from self._writeln(';')
+        yield from self._expect('> ')
+        content = file_content(local, minify)
+        log.info('Verifying using %s...' % verify)
+        if verify == 'raw':
+            data = yield from self._download_file(remote)
+            if content != data:
+                log.error('Raw verification failed.')
+                raise VerificationError('Verification failed.')
+            else:
+                log.info('Verification successful. Contents are identical.')
+        elif verify == 'sha1':
+            # Calculate SHA1 on remote file. Extract just hash from result
+            data = (yield from self._exchange('shafile("'+remote+'")')).splitlines()[1]
+            check_sha1(data, hashlib.sha1(content).hexdigest())
+
+        elif verify != 'none':
+            raise Exception(verify + ' is not a valid verification method.')
+
+    @recorded
+    def _exec_file(self, path, block=False):
+        """execute the lines in the local file 'path'.
+        With 'block' the file is run as one chunk instead, see exec_block()"""
+        filename = os.path.basename(path)
+        log.info('Execute %s', filename)
+        if block:
+            return (yield from self._exec_block(from_file(path)))
+
+        content = str(from_file(path), ENCODING).replace('\r', '').split('\n')
+
+        res = '> '
+        for line in content:
+            line = line.rstrip('\n')
+            retlines = (res + (yield from self._exchange(line))).splitlines()
+            # Log all but the last line
+            res = retlines.pop()
+            for lin in retlines:
+                log.info(lin)
+        # last line
+        log.info(res)
+
+    def _got_ack(self, sequence=False):
+        """Returns true if ACK is received.
+        With 'sequence' the ACK is followed by a block sequence number which
+        is returned instead, or None if the block was not acked."""
+        log.debug('waiting for ack')
+        start = time.time()
+        res = yield Read(2 if sequence else 1, self._timeout)
+        self.stats.wait('ack', time.time() - start)
+        self.stats.read(len(res))
+        acked = res[:1] == ACK
+        log.debug('ack read %s, comparing with %s. %s', hexify(res), hexify(ACK), acked)
+        if not sequence:
+            return acked
+        if not acked or len(res) != 2:
+            return None
+        return res[1]
+
+    @recorded
+    def _write_lines(self, data, block=False):
+        """write lines, one by one, separated by \\n to device.
+        With 'block' they are run as one chunk instead, see exec_block()"""
+        if block:
+            return (yield from self._exec_block(bytes(data, ENCODING)))
+        lines = data.replace('\r', '').split('\n')
+        for line in lines:
+            yield from self._exchange(line)
+
+    @recorded
+    def _exec_block(self, code):
+        """Runs code, bytes, with dofile() after sending it to a temporary file with
+        the transfer protocol. That is a few exchanges instead of one per line, but
+        unlike the line by line execution the first error ends it. What it prints
+        is logged line by line. Returns a BatchResult."""
+        yield from self._prepare()
+        yield from self._send(code, EXEC_FILE)
+        batch = Batch()
+        batch.file_do(EXEC_FILE)
+        batch.file_remove(EXEC_FILE)
+        return (yield from self._run_batch(batch))[0]
+
+    def _got_digest(self):
+        """The SHA1, as hex, that follows the ACK of the last block of a file,
+        or None if the device has no crypto.new_hash"""
+        start = time.time()
+        head = yield Read(1, self._timeout)
+        digest = (yield Read(head[0], self._timeout)) if head else b''
+        self.stats.wait('digest', time.time() - start)
+        self.stats.read(len(head) + len(digest))
+        if not head or len(digest) < head[0]:
+            self.stats.timeout()
+            raise CommunicationTimeout('Timeout waiting for the SHA1 of the file', head + digest)
+        return digest.hex() if digest else None
+
+    def _write_chunk(self, seq, chunk=bytes(), compressed=False):
+        """formats and sends a chunk of data to the device according to transfer protocol.
+        The ACK is read separately so that several chunks can be in flight"""
+        data = frame(seq, chunk, compressed)
+        log.debug('writing %d bytes chunk %d', len(chunk), seq)
+
+        log.debug("packet size %d", len(data))
+        yield from self._write(data)
+
+    def _read_chunk(self):
+        """Read a chunk of data"""
+        log.debug('reading chunk')
+        # start byte and length first, then exactly that much data
+        start = time.time()
+        head = yield Read(3, self._timeout)
+        size = chunk_size(head)
+        data = yield Read(size, self._timeout)
+        self.stats.wait('chunk', time.time() - start)
+        self.stats.read(len(head) + len(data))
+        if len(data) < size:
+            self.stats.timeout()
+            raise CommunicationTimeout('Timeout waiting for data', head + data)
+        return data
+
+    @recorded
+    def _query(self, *fields):
+        """The fields of query.FIELDS that are asked for, all in one exchange.
+        Returns a dict of field: value"""
+        return parse_query((yield from self._exec_chunk(query_code(fields))))
+
+    @recorded
+    def _file_list(self):
+        """list files on the device"""
+        log.info('Listing files')
+        return format_file_list((yield from self._query('files'))['files'])
+
+    @recorded
+    def _device_id(self):
+        """Returns an id of the device made from chip and flash id"""
+        state = yield from self._query('chip_id', 'flash_id')
+        return '{0}-{1}'.format(state['chip_id'], state['flash_id'])
+
+    def _load_manifest(self, path=None):
+        """Loads the cached manifest of the device and checks it against the
+        sizes on the device. It is then kept up to date by this uploader."""
+        manifest = Manifest((yield from self._device_id()), path)
+        manifest.validate(file_sizes((yield from self._file_list())))
+        manifest.save()
+        self.manifest = manifest
+        return manifest
+
+    def _remote_state(self, names):
+        """(size, sha1) of each of the named files on the device, or None if it doesn't exist.
+        The device is only asked to hash its files if the manifest doesn't know them all."""
+        manifest = self.manifest
+        if manifest is not None and all(manifest.known(name) for name in names):
+            log.info('Using cached state of the device')
+            return dict((name, manifest.get(name)) for name in names)
+        hashes = yield from self._file_hashes()
+        if manifest is not None:
+            manifest.files = dict(hashes)
+            manifest.save()
+        return dict((name, hashes.get(name)) for name in names)
+
+    def _forget(self, name=None):
+        """Updates the manifest about a removed file, or all files"""
+        if self.manifest is not None:
+            if name is None:
+                self.manifest.clear()
+            else:
+                self.manifest.remove(name)
+            self.manifest.save()
+
+    @recorded
+    def _file_hashes(self):
+        """Size and SHA1 of every file on the device, all in one exchange.
+        Returns a dict of filename: (size, sha1)"""
+        log.info('Listing files with SHA1')
+        return format_file_hashes((yield from self._query('hashes'))['hashes'])
+
+    @recorded
+    def _file_do(self, filename):
+        """Execute a file on the device using 'do'"""
+        log.info('Executing '+filename)
+        res = yield from self._exchange('dofile("'+filename+'")')
+        log.info(res)
+        return res
+
+    @recorded
+    def _file_format(self):
+        """Formats device filesystem"""
+        log.info('Formating, can take minutes depending on flash size...')
+        res = yield from self._exchange('file.format()', timeout=300)
+        self._forget()
+        if 'format done' not in res:
+            log.error(res)
+        else:
+            log.info(res)
+        return res
+
+    @recorded
+    def _file_print(self, filename):
+        """Prints a file on the device to console"""
+        log.info('Printing ' + filename)
+        res = yield from self._exchange(PRINT_FILE.format(filename=filename))
+        log.info(res)
+        return res
+
+    @recorded
+    def _file_remove_all(self):
+        log.info('Removing all files!!!')
+        res = yield from self._exchange(REMOVE_ALL_FILES)
+        self._forget()
+        log.info(res)
+        return res
+
+    @recorded
+    def _node_heap(self):
+        """Show device heap size"""
+        log.info('Heap')
+        heap = (yield from self._query('heap'))['heap']
+        log.info(heap)
+        return heap
+
+    @recorded
+    def _node_restart(self):
+        """Restarts device"""
+        log.info('Restart')
+        # the helpers are gone after the restart
+        self._helpers = False
+        res = yield from self._exchange('node.restart()')
+        log.info(res)
+        return res
+
+    @recorded
+    def _node_info(self):
+        """Node info"""
+        log.info('Node info')
+        res = format_info((yield from self._query(*INFO_GROUPS)))
+        log.info(res)
+        return res
+
+    @recorded
+    def _node_info_group(self, group):
+        log.info('Node info %s', group)
+        res = format_info((yield from self._query(group)))
+        log.info(res)
+        return res
+
+    @recorded
+    def _file_compile(self, path):
+        """Compiles a file specified by path on the device"""
+        log.info('Compile '+path)
+        cmd = 'node.compile("%s")' % path
+        res = yield from self._exchange(cmd)
+        if self.manifest is not None:
+            # exists but nothing else is known about it
+            self.manifest.update(os.path.splitext(path)[0] + '.lc')
+            self.manifest.save()
+        log.info(res)
+        return res
+
+    @recorded
+    def _file_remove(self, path):
+        """Removes a file on the device"""
+        log.info('Remove '+path)
+        cmd = 'file.remove("%s")' % path
+        res = yield from self._exchange(cmd)
+        self._forget(path)
+        log.info(res)
+        return res
+
+    @recorded
+    def _run_batch(self, batch):
+        """Runs the operations of batch, as chunks of at most a block each.
+        Returns a BatchResult per operation."""
+        results = []
+        for group in batch.split(self.block_size):
+            results += parse_batch((yield from self._exec_chunk(batch_code(group))), len(group))
+        for op, result in zip(batch.operations, results):
+            self._batch_done(op, result)
+        return results
+
+    def _batch_done(self, op, result):
+        """Logs the result of an operation of a batch and keeps the manifest up to date"""
+        log.info(describe(op))
+        for line in result.output.splitlines():
+            log.info(line)
+        if result.error is not None:
+            log.error(result.error)
+            return
+        if op.kind == 'file_remove':
+            self._forget(op.target)
+        elif op.kind == 'file_compile' and self.manifest is not None:
+            self.manifest.update(os.path.splitext(op.target)[0] + '.lc')
+            self.manifest.save()
+
+    @recorded
+    def _backup(self, path, incremental=False):
+        """Backup all files from the device.
+        Each file is streamed straight to disk. With 'incremental' only files
+        that are new or changed since the last backup in path are downloaded,
+        see BackupManifest. Returns the names of the files downloaded."""
+        log.info('Backing up in '+path)
+        if incremental:
+            return (yield from self._backup_changes(path))
+        # List file to backup
+        files = yield from self._file_list()
+        # then download each of then
+        yield from self._prepare()
+        sizes = file_sizes(files)
+        for f in files:
+            yield from self._read_file(f[0], os.path.join(path, f[0]), sizes.get(f[0]))
+        return [f[0] for f in files]
+
+    def _backup_changes(self, path):
+        """The incremental backup(), the device hashes all its files in one go"""
+        manifest = BackupManifest(path, (yield from self._device_id()))
+        hashes = yield from self._file_hashes()
+        yield from self._prepare()
+        changed = [name for name, entry in sorted(hashes.items()) if not backed_up(path, name, entry, manifest)]
+        for name in changed:
+            destination = os.path.join(path, name)
+            yield from self._read_file(name, destination, hashes[name][0])
+            content = from_file(destination)
+            manifest.update(name, len(content), hashlib.sha1(content).hexdigest())
+            if manifest.get(name) != hashes[name]:
+                log.warning('%s changed on the device while it was downloaded', name)
+            # an interrupted backup keeps what it got
+            manifest.save()
+        deleted = [name for name in manifest.files if name not in hashes]
+        for name in deleted:
+            log.info('%s was deleted on the device', name)
+            manifest.remove(name)
+        manifest.save()
+        log.info('%d files new or changed, %d unchanged and %d deleted',
+                 len(changed), len(hashes) - len(changed), len(deleted))
+        return changed
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""A daemon that keeps the connection to a device open between commands.
+
+    nodemcu-uploader --port /dev/ttyUSB0 --baud 921600 daemon start
+    nodemcu-uploader --port /dev/ttyUSB0 upload init.lua
+    nodemcu-uploader --port /dev/ttyUSB0 node heap
+    nodemcu-uploader --port /dev/ttyUSB0 daemon stop
+
+The daemon opens the port, syncs, switches baud and prepares the device once.
+Commands for the same port are then sent to it over a Unix socket, instead of
+opening the port themselves, and get their log, output and progress back.
+
+Every message is a line of json. A client sends one request, {"argv": [...],
+"cwd": ..., "level": ...}, {"status": true} or {"stop": true}, and gets
+{"log": [level, message]}, {"out": text} and {"progress": [...]} until the
+final {"exit": code}.
+"""
+
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from .uploader import Uploader
+from .fleet import device_name
+from .progress import Progress
+from .stats import Stats
+from .utils import cache_dir, ENCODING
+
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+__all__ = ['supported', 'socket_path', 'Session', 'serve', 'request', 'run', 'start', 'stop']
+
+# seconds that 'daemon start' waits for the daemon to take requests
+START_TIMEOUT = 30
+
+
+def supported():
+    """Unix sockets are needed, there are none on older Windows"""
+    return hasattr(socket, 'AF_UNIX')
+
+
+def socket_path(port):
+    """Where the daemon for port listens"""
+    return os.path.join(cache_dir(), 'sessions', device_name(port) + '.sock')
+
+
+class Session(object):
+    """The connection of the daemon to the device, an Uploader that has
+    been prepared. It can be opened again when the device was restarted."""
+
+    def __init__(self, port, **kwargs):
+        self.port = port
+        self.kwargs = kwargs
+        self.uploader = None
+
+    def open(self):
+        self.uploader = Uploader(self.port, **self.kwargs)
+        self.uploader.prepare()
+
+    def reopen(self):
+        log.info('reconnecting to %s', self.port)
+        self.close()
+        self.open()
+
+    def close(self):
+        if self.uploader is not None:
+            self.uploader.close()
+            self.uploader = None
+
+
+class _Connection(object):
+    """One client of the daemon"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+
+    def receive(self):
+        line = self.rfile.readline()
+        return json.loads(line.decode(ENCODING)) if line else None
+
+    def send(self, **message):
+        self.sock.sendall(json.dumps(message).encode(ENCODING) + b'\n')
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class _Output(object):
+    """Where the output of a request goes, back to its client"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, text):
+        if text:
+            self.connection.send(out=text)
+
+    def flush(self):
+        pass
+
+
+class _LogForwarder(logging.Handler):
+    def __init__(self, connection, level):
+        logging.Handler.__init__(self, level)
+        self.connection = connection
+
+    def emit(self, record):
+        try:
+            self.connection.send(log=[record.levelno, record.getMessage()])
+        except OSError:
+            # the client is gone, the request fails on its next output
+            pass
+
+
+def _reconnect(session):
+    """Opens the session again, False if the device can't be reached"""
+    try:
+        session.reopen()
+        return True
+    except Exception as e:  # pylint: disable=W0703
+        log.error('could not reconnect to %s: %s: %s', session.port, type(e).__name__, e)
+        return False
+
+
+def _run(session, execute, connection, message):
+    """Runs the command line of message with the session. Returns the exit code"""
+    forwarder = _LogForwarder(connection, message.get('level', logging.INFO))
+    root = logging.getLogger()
+    root_level = root.level
+    root.addHandler(forwarder)
+    root.setLevel(min(root_level, forwarder.level))
+    try:
+        # a reconnect after an earlier request failed, the device may be back
+        if session.uploader is None and not _reconnect(session):
+            return 1
+        uploader = session.uploader
+        # what the client gets to see is only about its own command
+        uploader.stats = Stats()
+
+        def progress(event):
+            connection.send(progress=list(event))
+        uploader.listeners.append(progress)
+        reconnect = True
+        try:
+            reconnect = execute(uploader, message['argv'], message.get('cwd', ''), _Output(connection))
+            code = 0
+        except Exception as e:  # pylint: disable=W0703
+            log.error('%s: %s', type(e).__name__, e)
+            code = 1
+        finally:
+            uploader.listeners.remove(progress)
+        # the device was restarted, or something went wrong, and is no longer in sync
+        if reconnect and not _reconnect(session):
+            code = 1
+        return code
+    finally:
+        root.removeHandler(forwarder)
+        root.setLevel(root_level)
+
+
+def _running(path):
+    """True if a daemon answers on path"""
+    return request(path, {'status': True}, out=io.StringIO()) is not None
+
+
+def _status(session):
+    if session.uploader is None:
+        return '{0} not connected, pid {1}\n'.format(session.port, os.getpid())
+    return '{0} at {1} baud, pid {2}\n'.format(session.port, session.uploader.baud, os.getpid())
+
+
+def serve(session, execute, path):
+    """Takes requests on the Unix socket at path until asked to stop.
+    execute(uploader, argv, cwd, out) runs a command line, with relative
+    paths from cwd and output written to out, and returns True if the
+    session must be opened again afterwards. Returns False, without
+    serving, if another daemon is listening on path already."""
+    if os.path.exists(path):
+        if _running(path):
+            log.error('there is a daemon serving %s already', path)
+            return False
+        # left behind by a daemon that is gone
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    dirpath = os.path.dirname(path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    server.bind(path)
+    server.listen(8)
+    log.info('serving %s on %s', session.port, path)
+    try:
+        while True:
+            sock, _ = server.accept()
+            connection = _Connection(sock)
+            try:
+                message = connection.receive()
+                if message is None:
+                    continue
+                if message.get('stop'):
+                    connection.send(exit=0)
+                    return True
+                if message.get('status'):
+                    connection.send(out=_status(session))
+                    connection.send(exit=0)
+                else:
+                    connection.send(exit=_run(session, execute, connection, message))
+            except (OSError, ValueError) as e:
+                # the client went away or sent garbage, the next one may be fine
+                log.warning('request failed: %s', e)
+            finally:
+                connection.close()
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def request(path, message, listener=None, out=None):
+    """Sends message to the daemon at path and relays what comes back, the
+    log to this process's log, the output to out, stdout if not given, and
+    the progress to listener. Returns the exit code or None if no daemon is
+    listening."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    connection = _Connection(sock)
+    try:
+        connection.send(**message)
+        while True:
+            answer = connection.receive()
+            if answer is None:
+                log.error('the daemon went away')
+                return 1
+            if 'log' in answer:
+                log.log(answer['log'][0], answer['log'][1])
+            elif 'out' in answer:
+                (out or sys.stdout).write(answer['out'])
+            elif 'progress' in answer:
+                if listener is not None:
+                    listener(Progress(*answer['progress']))
+            elif 'exit' in answer:
+                return answer['exit']
+    finally:
+        connection.close()
+
+
+def run(session, execute, path):
+    """Opens the session and serves it in the foreground until stopped.
+    Returns False if another daemon serves path already."""
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    # the port is the other daemon's, don't touch the device
+    if _running(path):
+        log.error('there is a daemon serving %s already', path)
+        return False
+    session.open()
+    try:
+        return serve(session, execute, path)
+    finally:
+        session.close()
+
+
+def start(path, argv):
+    """Runs the command line argv, that ends with 'daemon run', in the
+    background and waits until it takes requests. Returns True if it does."""
+    if _running(path):
+        log.error('there is a daemon running already')
+        return False
+    logpath = os.path.splitext(path)[0] + '.log'
+    os.makedirs(os.path.dirname(logpath), exist_ok=True)
+    with open(logpath, 'w') as logfile:
+        process = subprocess.Popen([sys.executable, '-m', 'nodemcu_uploader'] + argv,
+                                   stdin=subprocess.DEVNULL, stdout=logfile, stderr=logfile,
+                                   start_new_session=True)
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline and process.poll() is None:
+        if request(path, {'status': True}, out=io.StringIO()) == 0:
+            log.info('daemon started with pid %d, its log is in %s', process.pid, logpath)
+            return True
+        time.sleep(0.1)
+    if process.poll() is None:
+        process.terminate()
+    with open(logpath) as logfile:
+        log.error('the daemon did not start:\n%s', logfile.read().strip())
+    return False
+
+
+def stop(path):
+    """Asks the daemon at path to stop, False if there is none"""
+    return request(path, {'stop': True}) is not None
@@ -0,0 +1,833 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Emulator of a NodeMCU device for testing without hardware.
+
+Device has no Lua in it. Its interpreter only knows the statements that the
+uploader sends, see luacode, and answers them the way the firmware would,
+including the echo, the prompt and the binary transfer protocol of recv()
+and send(). LuaDevice runs everything it gets in Lua 5.1 instead, with lupa,
+so that the helper functions themselves are tested. It has the parts of the
+firmware modules that they use. The files live in memory.
+
+Connect to it with the pyserial URL nodemcu://[name][?latency=s&throttle=1&heap=bytes&max_baud=rate&lua=1],
+handled by protocol_nodemcu, or through a pseudo terminal with serve_pty() or::
+
+    python -m nodemcu_uploader.emulator
+
+Devices with a name are kept so that later connections find the same files.
+'latency' is added each way and with 'throttle' every byte takes as long as it
+would at the baudrate, so transfers take about as long as on real hardware.
+Above 'max_baud' everything is garbled both ways, like with a cheap adapter.
+"""
+
+import argparse
+import collections
+import hashlib
+import itertools
+import json
+import os
+import re
+import select
+import threading
+import time
+
+try:
+    # NodeMCU runs Lua 5.1, lupa 2 has it next to its default version
+    from lupa import lua51 as lupa
+except ImportError:
+    lupa = None
+
+from .compression import decompress_block
+from .luacode import PROTOCOL_INFO, CONNECT_PROBE, REMOVE_ALL_FILES, BAUD_CONFIRM
+from .query import FIELDS, encode
+from .utils import ENCODING
+
+__all__ = ['Device', 'LuaDevice', 'Link', 'device', 'serve_pty']
+
+BOOT_BAUD = 115200
+# NodeMCU reads up to this much with file.read() without argument
+FILE_READ_CHUNK = 1024
+
+# named devices, see device()
+_devices = {}
+_devices_lock = threading.Lock()
+
+
+def device(name, lua=False, **kwargs):
+    """Returns the emulated device called name, it is created if needed,
+    as a LuaDevice if lua is set"""
+    with _devices_lock:
+        if name not in _devices:
+            _devices[name] = (LuaDevice if lua else Device)(**kwargs)
+        return _devices[name]
+
+
+class LuaError(Exception):
+    """An error of the Lua code, it ends the statement or chunk that raised it"""
+
+
+def _command(pattern):
+    return re.compile(r'\s*' + pattern + r'\s*;?\s*$')
+
+
+def _literal(code):
+    return re.escape(code.strip())
+
+
+class Device(object):
+    """The device side of the serial line.
+    feed() takes what the device receives and returns what it sends back as
+    a list of (baudrate, bytes) since uart.setup() changes the rate midway.
+    """
+    HEAP = 40000
+    CHIP_ID = 1234567
+    FLASH_ID = 1458400
+    # older firmware has crypto without crypto.new_hash()
+    NEW_HASH = True
+    INFO = {
+        'hw': [('chip_id', CHIP_ID), ('flash_id', FLASH_ID), ('flash_size', 4096), ('flash_mode', 0),
+               ('flash_speed', 40000000)],
+        'sw_version': [('node_version_major', 3), ('node_version_minor', 0), ('node_version_revision', 0),
+                       ('git_branch', 'emulator')],
+        'build_config': [('ssl', False), ('lfs_size', 0), ('modules', 'crypto,file,node,uart'),
+                         ('number_type', 'float')],
+    }
+
+    def __init__(self, heap=HEAP, baud=None, max_baud=None):
+        # baud None means that the first data decides it, like the autobaud of the firmware
+        self.baud = baud
+        self.heap = heap
+        # the highest rate that gets through, None for no limit
+        self.max_baud = max_baud
+        self.files = {}
+        self._commands = [
+            (_command(''), lambda m: None),
+            (_command(_literal(PROTOCOL_INFO)), self._protocol_info),
+            (_command(_literal(CONNECT_PROBE)), self._connect_probe),
+            (_command(r"do local ok,e=pcall\(function\(\) (.*) end\) "
+                      r"print\(ok and '\\5' or '\\21'\.\.tostring\(e\)\) end"), self._batch_statement),
+            (_command(r'do local b,n=\{\},(\d+) local function f\(d\).*'), self._load_chunk),
+            (_command(r'print\((?:"([^"]*)"|\'([^\']*)\')\)'), lambda m: self._print(m.group(1) or m.group(2))),
+            (_command(r'print\(node\.heap\(\)\)'), lambda m: self._print(self.heap)),
+            (_command(r'uart\.setup\(0,(\d+),8,0,1,1\)'), self._uart_setup),
+            (_command(r'nmu_baud_t=nmu_baud_t or tmr\.create\(\) nmu_baud_t:unregister\(\) nmu_baud_ok=nil '
+                      r'nmu_baud_t:alarm\((\d+),tmr\.ALARM_SINGLE,function\(\) '
+                      r'if not nmu_baud_ok then uart\.setup\(0,(\d+),8,0,1,1\) end end\) '
+                      r'uart\.setup\(0,(\d+),8,0,1,1\)'), self._baud_trial),
+            (_command(_literal(BAUD_CONFIRM)), self._baud_confirm),
+            (_command(r'recv\((true)?\)'), self._recv),
+            (_command(r'send\("([^"]+)", (\d+), (\d+)\)'), self._send),
+            (_command(r'shafile\("([^"]+)"\)'), self._shafile),
+            (_command(r'prefix\("([^"]+)"(?:, (\d+))?\)'), self._prefix),
+            (_command(r"do local r=\{(.*)\} local function e\(v\) .*"), self._query),
+            (_command(_literal(REMOVE_ALL_FILES)), lambda m: self.files.clear()),
+            (_command(r'file\.remove\("([^"]+)"\)'), lambda m: self.files.pop(m.group(1), None)),
+            (_command(r'file\.format\(\)'), self._format),
+            (_command(r'node\.compile\("([^"]+)"\)'), self._compile),
+            (_command(r'dofile\("([^"]+)"\)'), self._dofile),
+            (_command(r'node\.restart\(\)'), lambda m: self._restart()),
+            (_command(r"file\.open\('([^']+)'\) print\('---[^']*---'\) print\(file\.read\(\)\) "
+                      r"file\.close\(\) print\('---'\)"), self._print_file),
+        ]
+        self.reset()
+
+    def reset(self):
+        """Like a restart, everything but the files is gone"""
+        # version of the helper functions from prepare(), None if they are missing
+        self.proto = None
+        self._line = bytearray()
+        # gets the data instead of the interpreter, like uart.on('data')
+        self._handler = None
+        self._out = []
+        # the (time, baudrate) of the timer of a baudrate trial
+        self._revert = None
+
+    def feed(self, data, baud=None):
+        """Handles data sent at baud, None if it matches the device.
+        Returns the answer as a list of (baudrate, bytes)"""
+        if self.baud is None:
+            self.baud = baud or BOOT_BAUD
+        self._tick()
+        if (baud is not None and baud != self.baud) or self._garbled():
+            data = b'\xff' * len(data)
+        data = bytes(data)
+        while len(data) > 0:
+            if self._handler is not None:
+                try:
+                    self._handler.send(data)
+                    data = b''
+                except StopIteration as stop:
+                    self._handler = None
+                    data = stop.value or b''
+                continue
+            end = data.find(b'\n')
+            line, data = (data, b'') if end == -1 else (data[:end], data[end + 1:])
+            self._emit(line.replace(b'\r', b''))
+            self._line += line
+            if end != -1:
+                self._emit(b'\r\n')
+                line = bytes(self._line).replace(b'\r', b'')
+                self._line = bytearray()
+                try:
+                    self._execute(str(line, ENCODING))
+                except LuaError as e:
+                    self._print(str(e))
+                self._emit(self._prompt())
+        out, self._out = self._out, []
+        return out
+
+    def _tick(self):
+        """Runs the timers that are due"""
+        if self._revert and self._revert[0] <= time.time():
+            self.baud = self._revert[1]
+            self._revert = None
+
+    def _prompt(self):
+        return b'> '
+
+    def _garbled(self):
+        return self.max_baud is not None and self.baud > self.max_baud
+
+    def _emit(self, data):
+        if len(data) > 0:
+            self._out.append((self.baud, b'\xff' * len(data) if self._garbled() else bytes(data)))
+
+    def _print(self, *values):
+        text = '\t'.join('nil' if v is None else str(v).lower() if isinstance(v, bool) else str(v) for v in values)
+        self._emit(bytes(text, ENCODING) + b'\r\n')
+
+    def _error(self, message):
+        raise LuaError('stdin:1: ' + message)
+
+    def _execute(self, code, strict=True):
+        """Runs one statement, anything unknown is an error if strict"""
+        for pattern, action in self._commands:
+            match = pattern.match(code)
+            if match:
+                action(match)
+                return
+        if strict:
+            self._error("the emulator can't run '{0}'".format(code.strip()))
+
+    def _run_chunk(self, code):
+        """Runs code with a statement per line. The helper functions from prepare()
+        are recognized by their version, the rest of their code is skipped."""
+        helpers = re.search(r'nmu_proto\s*=\s*(\d+)', code)
+        if helpers:
+            self.proto = int(helpers.group(1))
+        for line in code.split('\n'):
+            self._execute(line, strict=not helpers)
+
+    def _protocol_info(self, match):
+        self._print(self.proto, self.heap)
+
+    def _connect_probe(self, match):
+        self._protocol_info(match)
+        self._print('%sync%')
+
+    def _batch_statement(self, match):
+        try:
+            self._execute(match.group(1))
+            self._print('\x05')
+        except LuaError as e:
+            self._print('\x15' + str(e))
+
+    def _load_chunk(self, match):
+        def handler(size):
+            data = bytearray()
+            while len(data) < size:
+                data += yield
+            try:
+                self._run_chunk(str(bytes(data[:size]), ENCODING))
+            except LuaError as e:
+                self._print(str(e))
+            self._print('\x04')
+            return bytes(data[size:])
+        self._start(handler(int(match.group(1))))
+
+    def _start(self, handler):
+        next(handler)
+        self._handler = handler
+
+    def _uart_setup(self, match):
+        self.baud = int(match.group(1))
+
+    def _baud_trial(self, match):
+        # the trial rearms one named timer, so it replaces any pending revert
+        self._revert = (time.time() + int(match.group(1)) / 1000.0, int(match.group(2)))
+        self.baud = int(match.group(3))
+
+    def _baud_confirm(self, match):
+        self._revert = None
+
+    def _modules(self):
+        """What the firmware was built with"""
+        return dict(self.INFO['build_config'])['modules'].split(',')
+
+    def _new_hash(self):
+        return 'crypto' in self._modules() and self.NEW_HASH
+
+    def _helpers(self, name):
+        if self.proto is None:
+            self._error("attempt to call global '{0}' (a nil value)".format(name))
+
+    def _recv(self, match):
+        self._helpers('recv')
+        append = match.group(1) is not None
+
+        def handler():
+            data = bytearray()
+            while 0 not in data:
+                data += yield
+            name, _, rest = bytes(data).partition(b'\x00')
+            name = str(name, ENCODING)
+            if not append or name not in self.files:
+                self.files[name] = b''
+            self._emit(b'\x06')
+            data = bytearray(rest)
+            content = bytearray(self.files[name])
+            # only what is written now is hashed
+            hashed = len(content)
+            seq = 0
+            while True:
+                while len(data) < 4 or len(data) < 4 + data[2] * 256 + data[3]:
+                    data += yield
+                kind, number = data[0], data[1]
+                size = data[2] * 256 + data[3]
+                block = bytes(data[4:4 + size])
+                del data[:4 + size]
+                if kind not in (1, 2) or number != seq:
+                    self._emit(b'\x15' + bytes([number]))
+                    return bytes(data)
+                seq = (seq + 1) % 256
+                if kind == 2:
+                    block = decompress_block(block)
+                content += block
+                self.files[name] = bytes(content)
+                self._emit(b'\x06' + bytes([number]))
+                if len(block) == 0:
+                    digest = hashlib.sha1(content[hashed:]).digest() if self._new_hash() else b''
+                    self._emit(bytes([len(digest)]) + digest)
+                    return bytes(data)
+        self._start(handler())
+        self._emit(b'C')
+
+    def _send(self, match):
+        self._helpers('send')
+        name, size, offset = match.group(1), int(match.group(2)), int(match.group(3))
+
+        def block(data):
+            return b'\x01' + len(data).to_bytes(2, 'big') + data
+
+        def handler():
+            data = bytearray()
+            while len(data) == 0:
+                data += yield
+            if data[:1] != b'C':
+                self._print('transfer interrupted')
+                return bytes(data[1:])
+            del data[:1]
+            if name not in self.files:
+                # in a callback, the error is only printed
+                self._print("stdin:1: attempt to index a nil value")
+                return bytes(data)
+            content = self.files[name]
+            self._emit(bytes(name, ENCODING) + b'\x00')
+            pos = offset
+            while True:
+                while len(data) == 0:
+                    data += yield
+                answer = data[0]
+                del data[:1]
+                if answer != 6 or pos >= len(content):
+                    self._emit(block(b''))
+                    self._print('interrupted')
+                    return bytes(data)
+                self._emit(block(content[pos:pos + size]))
+                pos += size
+        self._start(handler())
+
+    def _shafile(self, match):
+        self._helpers('shafile')
+        if match.group(1) not in self.files:
+            self._error('could not open file')
+        self._print(hashlib.sha1(self.files[match.group(1)]).hexdigest())
+
+    def _query(self, match):
+        # the fields are the expressions of FIELDS, that may hold ',' and '='
+        expressions = dict((expression, field) for field, expression in FIELDS.items())
+        known = '|'.join(re.escape(e) for e in sorted(expressions, key=len, reverse=True))
+        pattern = re.compile(r'(\w+)=({0})(,|$)'.format(known))
+        table = {}
+        for name, expression, _ in pattern.findall(match.group(1)):
+            field = expressions[expression]
+            if field == 'files':
+                table[name] = dict((n, len(content)) for n, content in self.files.items())
+            elif field == 'heap':
+                table[name] = self.heap
+            elif field == 'chip_id':
+                table[name] = self.CHIP_ID
+            elif field == 'flash_id':
+                table[name] = self.FLASH_ID
+            elif field == 'hashes':
+                if 'crypto' not in self._modules():
+                    self._error("attempt to index global 'crypto' (a nil value)")
+                table[name] = dict((n, {'size': len(content), 'sha1': hashlib.sha1(content).hexdigest()})
+                                   for n, content in self.files.items())
+            else:
+                table[name] = dict(self.INFO.get(field, []))
+        # like sjson.encode() if the firmware has it
+        if 'sjson' in self._modules():
+            data = json.dumps(table, separators=(',', ':'))
+        else:
+            data = encode(table)
+        self._print('\x02' + data + '\x03')
+
+    def _prefix(self, match):
+        self._helpers('prefix')
+        if 'crypto' not in self._modules():
+            self._error("attempt to index global 'crypto' (a nil value)")
+        if not self.NEW_HASH:
+            self._error("attempt to call field 'new_hash' (a nil value)")
+        name = match.group(1)
+        if name not in self.files:
+            self._print(-1)
+            return
+        content = self.files[name]
+        count = len(content) if match.group(2) is None else int(match.group(2))
+        self._print(len(content), hashlib.sha1(content[:count]).hexdigest())
+
+    def _format(self, match):
+        self.files.clear()
+        self._print('format done')
+
+    def _compile(self, match):
+        name = match.group(1)
+        if name not in self.files:
+            self._error('cannot open ' + name)
+        # keeps the source so that dofile() can run it
+        self.files[os.path.splitext(name)[0] + '.lc'] = b'\x1bLua' + self.files[name]
+
+    def _dofile(self, match):
+        name = match.group(1)
+        if name not in self.files:
+            self._error('cannot open ' + name)
+        code = self.files[name]
+        if code.startswith(b'\x1bLua'):
+            code = code[4:]
+        self._run_chunk(str(code, ENCODING))
+
+    def _restart(self):
+        self._emit(b'> ')
+        out = self._out
+        self.reset()
+        # the boot loader talks at its own rate before the firmware is back at the boot rate
+        self._out = out + [(74880, b'\r\n ets Jan  8 2013,rst cause:2, boot mode:(3,6)\r\n')]
+        self.baud = BOOT_BAUD
+        self._emit(b'\r\nNodeMCU emulator\r\n')
+
+    def _print_file(self, match):
+        name = match.group(1)
+        if name not in self.files:
+            self._error("attempt to call field 'read' (a nil value)")
+        self._print('---' + name + '---')
+        self._print(str(self.files[name][:FILE_READ_CHUNK], ENCODING))
+        self._print('---')
+
+
+# the modules of the firmware, as far as the uploader uses them, on top of _Firmware.
+# The chunk returns the function that runs a statement or callback with them.
+FIRMWARE = r"""
+local dev = ...
+
+function print(...)
+    local t = {}
+    for i = 1, select('#', ...) do t[i] = tostring((select(i, ...))) end
+    dev.write(table.concat(t, '\t') .. '\r\n')
+end
+
+uart = {}
+function uart.setup(id, baud) dev.setup(baud) return baud end
+function uart.write(id, ...)
+    for i = 1, select('#', ...) do
+        local v = select(i, ...)
+        dev.write(type(v) == 'number' and string.char(v) or v)
+    end
+end
+function uart.on(event, n, callback, run)
+    if type(n) == 'number' and (n < 0 or n > 255) then error('wrong arg range') end
+    dev.on(n, callback)
+end
+
+file = {}
+local handle = {}
+handle.__index = handle
+function handle:read(n)
+    local d = dev.read(self.name, self.pos, n or 1024)
+    if d then self.pos = self.pos + #d end
+    return d
+end
+function handle:write(s) dev.put(self.name, self.pos, s) self.pos = self.pos + #s return true end
+function handle:seek(whence, offset)
+    whence, offset = whence or 'cur', offset or 0
+    if whence == 'set' then self.pos = offset
+    elseif whence == 'end' then self.pos = dev.size(self.name) + offset
+    else self.pos = self.pos + offset end
+    return self.pos
+end
+function handle:close() end
+local current
+function file.open(name, mode)
+    mode = (mode or 'r'):sub(1, 1)
+    if mode == 'r' and not dev.size(name) then return nil end
+    if mode == 'w' or not dev.size(name) then dev.create(name) end
+    current = setmetatable({name = name, pos = mode == 'a' and dev.size(name) or 0}, handle)
+    return current
+end
+function file.read(n) return current:read(n) end
+function file.write(s) return current:write(s) end
+function file.close() current = nil end
+function file.exists(name) return dev.size(name) ~= nil end
+file.list = dev.list
+file.remove = dev.remove
+function file.format() dev.format() print('format done') end
+
+node = {heap = dev.heap, chipid = dev.chipid, flashid = dev.flashid, info = dev.info, restart = dev.restart}
+-- the emulated bytecode is the source after the signature, so that dofile() can run it
+function node.compile(name)
+    local source = dev.content(name)
+    if not source then error('cannot open ' .. name, 2) end
+    local f, e = loadstring(source, '@' .. name)
+    if not f then error(e, 0) end
+    dev.create((name:gsub('%.[^.]*$', '')) .. '.lc', '\27Lua' .. source)
+end
+function dofile(name)
+    local code = dev.content(name)
+    if not code then error('cannot open ' .. name, 2) end
+    if code:sub(1, 4) == '\27Lua' then code = code:sub(5) end
+    local f, e = loadstring(code, '@' .. name)
+    if not f then error(e, 0) end
+    return f()
+end
+
+tmr = {ALARM_SINGLE = 0, ALARM_SEMI = 1, ALARM_AUTO = 2}
+local timer = {}
+timer.__index = timer
+function tmr.create() return setmetatable({id = dev.timer()}, timer) end
+function timer:alarm(interval, mode, callback) dev.alarm(self.id, interval, mode, callback) return true end
+function timer:unregister() dev.unregister(self.id) end
+
+-- only there if the firmware was built with them
+local optional = {}
+optional.crypto = {
+    toHex = function(s) return (s:gsub('.', function(c) return string.format('%02x', c:byte()) end)) end,
+    hash = function(algorithm, s) return dev.sha1(s) end,
+    fhash = function(algorithm, name)
+        local d = dev.content(name)
+        if not d then error('could not open file', 2) end
+        return dev.sha1(d)
+    end,
+}
+local function new_hash(algorithm)
+    local parts = {}
+    return {update = function(h, s) parts[#parts + 1] = s end,
+            finalize = function(h) return dev.sha1(table.concat(parts)) end}
+end
+optional.sjson = {encode = dev.json}
+
+return function(callback, ...)
+    for name, module in pairs(optional) do
+        if dev.built(name) then _G[name] = module else _G[name] = nil end
+    end
+    optional.crypto.new_hash = dev.new_hash() and new_hash or nil
+    local ok, e = pcall(callback, ...)
+    if not ok then print(e) end
+end
+"""
+
+
+class _Firmware(object):
+    """What FIRMWARE calls in the LuaDevice, names are str and contents bytes here"""
+
+    def __init__(self, device):
+        self.device = device
+
+    def _name(self, name):
+        return str(name, ENCODING)
+
+    def _table(self, mapping):
+        return self.device.lua.table_from(dict(
+            (bytes(k, ENCODING), bytes(v, ENCODING) if isinstance(v, str) else v) for k, v in mapping.items()))
+
+    def _python(self, value):
+        """value from Lua, like sjson decodes it"""
+        if lupa.lua_type(value) != 'table':
+            return str(value, ENCODING) if isinstance(value, bytes) else value
+        items = [(self._python(k), self._python(v)) for k, v in value.items()]
+        if [k for k, _ in items] == list(range(1, len(items) + 1)):
+            # sjson has no way to tell an empty table from an empty list
+            return [v for _, v in items]
+        return dict(items)
+
+    def write(self, data):
+        self.device._emit(data)
+
+    def setup(self, baud):
+        self.device.baud = int(baud)
+
+    def on(self, size, callback):
+        self.device._uart_on(size, callback)
+
+    def size(self, name):
+        content = self.device.files.get(self._name(name))
+        return None if content is None else len(content)
+
+    def content(self, name):
+        return self.device.files.get(self._name(name))
+
+    def read(self, name, pos, count):
+        content = self.device.files.get(self._name(name), b'')
+        pos = int(pos)
+        return content[pos:pos + int(count)] if pos < len(content) else None
+
+    def put(self, name, pos, data):
+        name, pos = self._name(name), int(pos)
+        content = self.device.files[name]
+        self.device.files[name] = content[:pos] + data + content[pos + len(data):]
+
+    def create(self, name, content=b''):
+        self.device.files[self._name(name)] = bytes(content)
+
+    def remove(self, name):
+        self.device.files.pop(self._name(name), None)
+
+    def list(self):
+        return self._table(dict((name, len(content)) for name, content in self.device.files.items()))
+
+    def format(self):
+        self.device.files.clear()
+
+    def heap(self):
+        return self.device.heap
+
+    def chipid(self):
+        return self.device.CHIP_ID
+
+    def flashid(self):
+        return self.device.FLASH_ID
+
+    def info(self, group):
+        return self._table(dict(self.device.INFO.get(self._name(group), [])))
+
+    def restart(self):
+        self.device._restart()
+
+    def timer(self):
+        return next(self.device._timer_ids)
+
+    def alarm(self, timer, interval, mode, callback):
+        self.device._timers[timer] = (time.time() + interval / 1000.0, interval, mode, callback)
+
+    def unregister(self, timer):
+        self.device._timers.pop(timer, None)
+
+    def sha1(self, data):
+        return hashlib.sha1(data).digest()
+
+    def json(self, table):
+        return bytes(json.dumps(self._python(table), separators=(',', ':')), ENCODING)
+
+    def built(self, module):
+        return self._name(module) in self.device._modules()
+
+    def new_hash(self):
+        return self.device.NEW_HASH
+
+
+class LuaDevice(Device):
+    """A Device that runs what it gets in Lua, the firmware modules are in
+    FIRMWARE. Needs lupa."""
+    TMR_ALARM_AUTO = 2
+
+    def __init__(self, heap=Device.HEAP, baud=None, max_baud=None):
+        if lupa is None:
+            raise ImportError('LuaDevice needs lupa')
+        self._timer_ids = itertools.count()
+        Device.__init__(self, heap, baud, max_baud)
+
+    def reset(self):
+        Device.reset(self)
+        # the start of a statement that goes on on the next line
+        self._pending = ''
+        # what uart.on('data') was given, (size or end character, callback)
+        self._on = None
+        # how many times that callback was called
+        self.uart_callbacks = 0
+        # {id: (when, interval, mode, callback)} of the armed timers
+        self._timers = {}
+        self.lua = lupa.LuaRuntime(encoding=None, unpack_returned_tuples=True)
+        self._run = self.lua.execute(bytes(FIRMWARE, ENCODING), _Firmware(self))
+
+    def _call(self, function, *args):
+        """Runs a statement or callback, an error is printed like the firmware does"""
+        self._run(function, *args)
+        self.proto = self.lua.globals().nmu_proto
+
+    def _execute(self, code, strict=True):
+        code = self._pending + code
+        self._pending = ''
+        loaded = self.lua.globals().loadstring(bytes(code, ENCODING), b'=stdin')
+        function, error = loaded if isinstance(loaded, tuple) else (loaded, None)
+        if function is None:
+            if error.endswith(b"'<eof>'"):
+                self._pending = code + '\n'
+                return
+            raise LuaError(str(error, ENCODING))
+        self._call(function)
+
+    def _prompt(self):
+        return b'>> ' if self._pending else b'> '
+
+    def _tick(self):
+        now = time.time()
+        for timer, (when, interval, mode, callback) in sorted(self._timers.items()):
+            if when <= now and timer in self._timers:
+                if mode == self.TMR_ALARM_AUTO:
+                    self._timers[timer] = (when + interval / 1000.0, interval, mode, callback)
+                else:
+                    del self._timers[timer]
+                self._call(callback)
+
+    def _uart_on(self, size, callback):
+        self._on = None if callback is None else (size, callback)
+        if self._on is not None and self._handler is None:
+            self._start(self._receive())
+
+    def _receive(self):
+        """Gives what arrives to the callback of uart.on('data') until it is unregistered"""
+        data = bytearray()
+        while self._on is not None:
+            size, callback = self._on
+            if isinstance(size, bytes):
+                count = data.find(size) + 1
+            elif size == 0:
+                # the firmware calls back for every character
+                count = min(1, len(data))
+            else:
+                count = int(size) if len(data) >= size else 0
+            if count == 0:
+                data += yield
+                continue
+            piece = bytes(data[:count])
+            del data[:count]
+            self.uart_callbacks += 1
+            self._call(callback, piece)
+        return bytes(data)
+
+
+class Link(object):
+    """A serial line between the host and a device with the timing of a real one.
+    Everything is handled at once but the answers only become readable when
+    they would have arrived."""
+
+    def __init__(self, device, latency=0.0, throttle=False):
+        self.device = device
+        self.latency = latency
+        self.throttle = throttle
+        # when each direction is done with what it has been given
+        self._sending = 0.0
+        self._receiving = 0.0
+        # (time when readable, bytes)
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+
+    def byte_time(self, baud):
+        """Seconds per byte, start and stop bit included"""
+        return 10.0 / baud if self.throttle and baud else 0.0
+
+    def write(self, data, baud=None):
+        """Sends data at baud to the device. Returns the time when it is all sent"""
+        with self._lock:
+            now = time.time()
+            self._sending = max(now, self._sending) + len(data) * self.byte_time(baud or self.device.baud)
+            start = self._sending + self.latency
+            for out_baud, out in self.device.feed(data, baud):
+                self._receiving = max(start, self._receiving) + len(out) * self.byte_time(out_baud)
+                if baud is not None and out_baud != baud:
+                    out = b'\xff' * len(out)
+                self._pending.append((self._receiving + self.latency, out))
+            return self._sending
+
+    def read(self):
+        """Returns everything that has arrived"""
+        with self._lock:
+            now = time.time()
+            data = bytearray()
+            while self._pending and self._pending[0][0] <= now:
+                data += self._pending.popleft()[1]
+            return bytes(data)
+
+    def next_arrival(self):
+        """When more data arrives, None if nothing is on the way"""
+        with self._lock:
+            return self._pending[0][0] if self._pending else None
+
+
+def serve_pty(dev=None, latency=0.0, throttle=False):
+    """Serves a device on a new pseudo terminal. Returns its path and
+    a function that stops serving. The rate of the terminal is ignored, the
+    host always talks at the rate of the device."""
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    link = Link(dev or Device(), latency, throttle)
+    stop = threading.Event()
+
+    def serve():
+        try:
+            while not stop.is_set():
+                arrival = link.next_arrival()
+                wait = 0.1 if arrival is None else min(0.1, max(0.0, arrival - time.time()))
+                readable, _, _ = select.select([master], [], [], wait)
+                if readable:
+                    link.write(os.read(master, 4096))
+                data = link.read()
+                if data:
+                    os.write(master, data)
+        finally:
+            os.close(master)
+            os.close(slave)
+
+    thread = threading.Thread(target=serve, name='emulator')
+    thread.daemon = True
+    thread.start()
+
+    def close():
+        stop.set()
+        thread.join()
+    return os.ttyname(slave), close
+
+
+def main_func():
+    """Serves an emulated device on a pseudo terminal until interrupted"""
+    parser = argparse.ArgumentParser(description='NodeMCU emulator on a pseudo terminal',
+                                     prog='python -m nodemcu_uploader.emulator')
+    parser.add_argument('--latency', '-l', help='Latency each way in seconds', type=float, default=0.0)
+    parser.add_argument('--throttle', '-t', help='Transfer bytes at the speed of the baudrate',
+                        action='store_true', default=False)
+    parser.add_argument('--heap', help='Free heap to report', type=int, default=Device.HEAP)
+    parser.add_argument('--max-baud', help='Garble everything above this baudrate', type=int, default=None)
+    parser.add_argument('--lua', help='Run the Lua code, needs lupa', action='store_true', default=False)
+    args = parser.parse_args()
+    dev = (LuaDevice if args.lua else Device)(args.heap, max_baud=args.max_baud)
+    path, close = serve_pty(dev, args.latency, args.throttle)
+    print('Emulated NodeMCU on ' + path)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        close()
+
+
+if __name__ == '__main__':
+    main_func()
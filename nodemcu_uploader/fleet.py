@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Running the same operation on many devices at the same time"""
+
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .uploader import Uploader
+from .serialutils import find_ports
+
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+__all__ = ['FleetResult', 'fleet_ports', 'device_name', 'run_fleet', 'log_summary']
+
+
+class FleetResult(object):
+    """Outcome of the operation on one device"""
+    def __init__(self, port, error=None, duration=0.0):
+        self.port = port
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def fleet_ports(spec, vid=None, pid=None):
+    """Ports from a comma separated list, or all ports matching vid and pid if spec is 'auto'"""
+    if spec == 'auto':
+        return find_ports(vid, pid)
+    return [port.strip() for port in spec.split(',') if port.strip()]
+
+
+def device_name(port):
+    """A name for the port that is usable as a folder or log prefix"""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', port.rstrip('/\\').split('/')[-1].split('\\')[-1])
+
+
+def run_fleet(ports, task, jobs=None, **kwargs):
+    """Calls task(uploader, port) for an Uploader(port, **kwargs) on each of the ports,
+    at most 'jobs' at the same time. Each device runs in a thread named after the port
+    so log records can tell them apart. Returns a FleetResult per port."""
+
+    def work(port):
+        threading.current_thread().name = device_name(port)
+        start = time.time()
+        try:
+            uploader = Uploader(port, **kwargs)
+            try:
+                task(uploader, port)
+            finally:
+                uploader.close()
+        except Exception as e:  # pylint: disable=W0703
+            log.error('failed: %s', e)
+            return FleetResult(port, e, time.time() - start)
+        log.info('done')
+        return FleetResult(port, None, time.time() - start)
+
+    if len(ports) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=jobs or len(ports)) as executor:
+        return list(executor.map(work, ports))
+
+
+def log_summary(results):
+    """Logs a line per device and a total. Returns True if all devices passed"""
+    for result in results:
+        log.info('%-20s %s %6.1fs %s', result.port, 'PASS' if result.ok else 'FAIL', result.duration,
+                 result.error or '')
+    failed = len([result for result in results if not result.ok])
+    log.info('%d of %d devices passed', len(results) - failed, len(results))
+    return failed == 0
@@ -7,46 +7,109 @@ to perform whats needed. They will be uploaded if they doesn't exist"""
 # flake8: noqa
 
 
-LUA_FUNCTIONS = ['recv_block', 'recv_name', 'recv', 'shafile', 'send_block', 'send_file', 'send']
+# bump whenever the transfer protocol below changes so that old helpers get replaced
+PROTOCOL_VERSION = 6
 
-DOWNLOAD_FILE = "file.open('{filename}') print(file.seek('end', 0)) file.seek('set', {bytes_read}) uart.write(0, file.read({chunk_size}))file.close()"
+LUA_FUNCTIONS = ['recv', 'shafile', 'prefix', 'send']
+
+# version of the installed helpers, if they are all there, and the free heap that decides the block size
+PROTOCOL_INFO = 'print({functions} and nmu_proto, node.heap())'.format(functions=' and '.join(LUA_FUNCTIONS))
+
+# one statement of a batch, see batch. It prints \5 when done or \21 and the error if it failed
+BATCH_STATEMENT = "do local ok,e=pcall(function() {code} end) print(ok and '\\5' or '\\21'..tostring(e)) end"
+
+# PROTOCOL_INFO and a marker to wait for, to see if a device is live without the autobaud sequence
+CONNECT_PROBE = PROTOCOL_INFO + ' print("%sync%")'
+
+# what LOAD_CHUNK prints when the chunk is done
+CHUNK_DONE = '\x04\r\n'
+
+# reads {size} bytes and runs them as one chunk, so that code of any length can be
+# sent in one go without the line length limit and the prompt of the interpreter.
+# uart.on can not wait for more than 255 bytes so it is re-armed for what is left
+LOAD_CHUNK = "do local b,n={{}},{size} local function f(d) b[#b+1]=d n=n-#d if n>0 then return uart.on('data',math.min(255,n),f,0) end uart.on('data') local c,e=(loadstring or load)(table.concat(b)) if c then c,e=pcall(c) if c then e=nil end end if e then print(e) end print('\\4') end uart.on('data',math.min(255,n),f,0) end"
 
 PRINT_FILE = "file.open('{filename}') print('---{filename}---') print(file.read()) file.close() print('---')"
 
-INFO_GROUP = "for key,value in pairs(node.info('{group}')) do k=tostring(key) print(k .. string.rep(' ', 20 - #k), tostring(value)) end"
+# prints the table of {fields} between \2 and \3, as json if the firmware has sjson or else
+# as s<len>:<text>, n<len>:<text> or b<len>:<text> for strings, numbers and booleans and t<key><value>...e for tables
+QUERY = "do local r={{{fields}}} local function e(v) local t=type(v) if t=='table' then local o={{'t'}} for k,x in pairs(v) do o[#o+1]=e(tostring(k))..e(x) end return table.concat(o)..'e' end v=tostring(v) return t:sub(1,1)..#v..':'..v end print('\\2'..(sjson and sjson.encode(r) or e(r))..'\\3') end"
 
-LIST_FILES = 'for key,value in pairs(file.list()) do print(key,value) end'
-# NUL = \000, ACK = \006
+# NUL = \000, ACK = \006, NAK = \025
+# blocks carry exactly their payload, the block size z is only an upper limit decided by the host
+# upload blocks are \001 <seq> <len hi> <len lo> <data> and are acked with \006 <seq>
+# \002 instead of \001 is a block compressed as in compression.py
+# the ack of the empty block that ends a file is followed by <len> <sha1 of the file>, len is 0 without crypto.new_hash
+# recv(true) appends to the file instead of replacing it, to resume an upload
+# prefix(f, n) prints the size of f and the SHA1 of its first n bytes, or of all of it, and -1 if it's missing
+# uart.on can not wait for more than 255 bytes, so after the 4 byte header a block is read in
+# pieces of at most that, re-arming uart.on for what is left of it
 RECV_LUA = \
 r"""
-function recv()
+nmu_proto = 6
+function recv(a)
     local on,w,ack,nack=uart.on,uart.write,'\6','\21'
-    local fd
+    local fd,n,b,z,t,s,h,recv_head
+    local function inflate(d)
+        local q,i = {},1
+        while i <= #d do
+            local h = d:byte(i)
+            if h < 128 then q[#q+1] = d:sub(i+1, i+h+1) i = i + h + 2
+            else
+                local l,f = h - 124, d:byte(i+1) * 256 + d:byte(i+2)
+                -- only the last pieces, that the copy reaches back into, are joined
+                local j,c = #q,0
+                while c < f and j > 0 do c = c + #q[j] j = j - 1 end
+                local p = table.concat(q, '', j+1):sub(c-f+1, c-f+l)
+                while #p < l do p = p .. p:sub(1, l-#p) end
+                q[#q+1] = p i = i + 3
+            end
+        end
+        return table.concat(q)
+    end
     local function recv_block(d)
-        local t,l = d:byte(1,2)
-        if t ~= 1 then w(0, nack); fd:close(); return on('data') end
-        if l >= 0  then fd:write(d:sub(3, l+2)); end
-        if l == 0 then fd:close(); w(0, ack); return on('data') else w(0, ack) end
+        b[#b+1] = d z = z - #d
+        if z > 0 then return on('data', math.min(255, z), recv_block, 0) end
+        d = table.concat(b) b = nil
+        n = (n + 1) % 256
+        if t == 2 then d = inflate(d) end
+        if #d ~= 0 then fd:write(d) if h then h:update(d) end on('data', 4, recv_head, 0) else fd:close(); on('data') end
+        w(0, ack .. string.char(s))
+        if #d == 0 then d = h and h:finalize() or '' return w(0, string.char(#d) .. d) end
+    end
+    recv_head = function(d)
+        t,s,z = d:byte(1), d:byte(2), d:byte(3) * 256 + d:byte(4)
+        if (t ~= 1 and t ~= 2) or s ~= n then fd:close(); on('data'); return w(0, nack .. string.char(s)) end
+        b = {}
+        if z > 0 then on('data', math.min(255, z), recv_block, 0) else recv_block('') end
     end
-    local function recv_name(d) d = d:gsub('%z.*', '') d:sub(1,-2) file.remove(d) fd=file.open(d, 'w') on('data', 130, recv_block, 0) w(0, ack) end
+    local function recv_name(d) d = d:gsub('%z.*', '') if not a then file.remove(d) end fd=file.open(d, a and 'a' or 'w') n=0 h=crypto and crypto.new_hash and crypto.new_hash('sha1') on('data', 4, recv_head, 0) w(0, ack) end
     on('data', '\0', recv_name, 0)
     w(0, 'C')
   end
 function shafile(f) print(crypto.toHex(crypto.fhash('sha1', f))) end
+function prefix(f, n)
+    local fd,h=file.open(f),crypto.new_hash('sha1')
+    if not fd then return print(-1) end
+    local s=fd:seek('end', 0) n=math.min(n or s, s) fd:seek('set', 0)
+    while n > 0 do local d=fd:read(math.min(n, 1024)) if not d then break end h:update(d) n=n-#d end
+    fd:close() print(s, crypto.toHex(h:finalize()))
+end
 """  # noqa: E122
 
+# download blocks are \001 <len hi> <len lo> <data>, send(f, z, o) starts at offset o
 SEND_LUA = \
 r"""
-function send(f) uart.on('data', 1, function (data)
+function send(f, z, o) uart.on('data', 1, function (data)
   local on,w=uart.on,uart.write
   local fd
-  local function send_block(d) l = string.len(d) w(0, '\001' .. string.char(l) .. d .. string.rep('\0', 128 - l)) return l end
+  local function send_block(d) local l = string.len(d) w(0, '\001' .. string.char(math.floor(l / 256), l % 256) .. d) return l end
   local function send_file(f)
     local s, p
-    fd=file.open(f) s=fd:seek('end', 0) p=0
+    fd=file.open(f) s=fd:seek('end', 0) p=o or 0
     on('data', 1, function(data)
       if data == '\006' and p<s then
-        fd:seek('set',p) p=p+send_block(fd:read(128))
+        fd:seek('set',p) p=p+send_block(fd:read(z))
       else
         send_block('') fd:close() on('data') print('interrupted')
       end
@@ -59,6 +122,14 @@ end
 
 UART_SETUP = 'uart.setup(0,{baud},8,0,1,1)'
 
+# switches to baud for a trial, the timer goes back to fallback unless BAUD_CONFIRM arrives in time.
+# Every trial rearms the same timer so one that failed can't revert a later one.
+BAUD_TRIAL = "nmu_baud_t=nmu_baud_t or tmr.create() nmu_baud_t:unregister() nmu_baud_ok=nil " \
+             "nmu_baud_t:alarm({time},tmr.ALARM_SINGLE,function() " \
+             "if not nmu_baud_ok then uart.setup(0,{fallback},8,0,1,1) end end) uart.setup(0,{baud},8,0,1,1)"
+
+BAUD_CONFIRM = 'nmu_baud_ok=true'
+
 REMOVE_ALL_FILES = r"""
 for key,value in pairs(file.list()) do file.remove(key) end
 """
@@ -6,12 +6,20 @@
 from __future__ import print_function
 
 import argparse
+import functools
 import logging
 import os
 import sys
 import glob
+import hashlib
+import json
 import serial
 from .uploader import Uploader
+from .core import file_content, BAUD_AUTO
+from .batch import describe
+from . import daemon
+from .fleet import fleet_ports, device_name, run_fleet, log_summary
+from .progress import ProgressBar
 from .term import terminal
 from serial import VERSION as serialversion
 from .version import __version__
@@ -20,12 +28,13 @@ from .version import __version__
 log = logging.getLogger(__name__)  # pylint: disable=C0103
 
 
-def destination_from_source(sources, use_glob=True):
+def destination_from_source(sources, use_glob=True, cwd=''):
     """
     Split each of the sources in the array on ':'
     First part will be source, second will be destination.
     Modifies the the original array to contain only sources
     and returns an array of destinations.
+    Globs are matched in cwd, if given, but what they match is relative to it.
     """
     destinations = []
     newsources = []
@@ -36,8 +45,10 @@ def destination_from_source(sources, use_glob=True):
             newsources.append(srcdst[0])  # proper list assignment
         else:
             if use_glob:
-                listing = glob.glob(srcdst[0])
+                base = os.path.join(cwd, '') if cwd and not os.path.isabs(srcdst[0]) else ''
+                listing = glob.glob(glob.escape(base) + srcdst[0])
                 for filename in listing:
+                    filename = filename[len(base):]
                     newsources.append(filename)
                     # always use forward slash at destination
                     destinations.append(filename.replace('\\', '/'))
@@ -48,27 +59,60 @@ def destination_from_source(sources, use_glob=True):
     return [newsources, destinations]
 
 
-def operation_upload(uploader, sources, verify, do_compile, do_file, do_restart):
-    """The upload operation"""
+def is_synced(filename, remote, minify='none'):
+    """Check if the local file, as it would be uploaded, has the same size and SHA1
+    as the (size, sha1) of the remote file. remote is None if it doesn't exist on the device."""
+    if remote is None:
+        return False
+    content = file_content(filename, minify)
+    return len(content) == remote[0] and hashlib.sha1(content).hexdigest() == remote[1]
+
+
+def run_batch(uploader, batch):
+    """Runs batch with uploader and raises if any of its operations failed"""
+    batch.results = uploader.run_batch(batch)
+    failed = ['{0}: {1}'.format(describe(op), result.error)
+              for op, result in zip(batch.operations, batch.results) if result.error is not None]
+    if failed:
+        raise Exception('Remote operations failed. ' + '; '.join(failed))
+
+
+def operation_upload(uploader, sources, verify, do_compile, do_file, do_restart, window=None, sync=False,
+                     compress=False, minify='none', resume=False, cwd=''):
+    """The upload operation. Relative paths of sources are from cwd, if given."""
     if not isinstance(sources, list):
         sources = [sources]
-    sources, destinations = destination_from_source(sources)
+    sources, destinations = destination_from_source(sources, cwd=cwd)
+    sources = [os.path.join(cwd, filename) for filename in sources]
     if len(destinations) == len(sources):
         if uploader.prepare():
+            remote = uploader.remote_state(destinations) if sync else {}
+            todo = []
             for filename, dst in zip(sources, destinations):
-                if do_compile:
-                    uploader.file_remove(os.path.splitext(dst)[0]+'.lc')
                 if not os.path.exists(filename) and not os.path.isfile(filename):
                     raise Exception("File does not exist. {filename}".format(filename=filename))
-                uploader.write_file(filename, dst, verify)
+                if sync and is_synced(filename, remote.get(dst), minify):
+                    log.info('Skipping %s, unchanged on device', dst)
+                    continue
+                todo.append((filename, dst))
+            # the remote operations between two transfers go in one batch,
+            # what is done after a file and before the next one
+            batch = uploader.batch()
+            for filename, dst in todo:
+                if do_compile:
+                    batch.file_remove(os.path.splitext(dst)[0]+'.lc')
+                run_batch(uploader, batch)
+                uploader.write_file(filename, dst, verify, window, compress, minify, resume)
+                batch = uploader.batch()
                 # init.lua is not allowed to be compiled
                 if do_compile and dst != 'init.lua':
-                    uploader.file_compile(dst)
-                    uploader.file_remove(dst)
+                    batch.file_compile(dst)
+                    batch.file_remove(dst)
                     if do_file:
-                        uploader.file_do(os.path.splitext(dst)[0]+'.lc')
+                        batch.file_do(os.path.splitext(dst)[0]+'.lc')
                 elif do_file:
-                    uploader.file_do(dst)
+                    batch.file_do(dst)
+            run_batch(uploader, batch)
         else:
             raise Exception('Error preparing nodemcu for reception')
     else:
@@ -86,11 +130,12 @@ def operation_download(uploader, sources, *args, **kwargs):
     # print('sources', sources)
     # print('destinations', destinations)
     dest = kwargs.pop('dest', '')
+    resume = kwargs.pop('resume', False)
     if len(destinations) == len(sources):
         if uploader.prepare():
             for filename, dst in zip(sources, destinations):
                 dst = os.path.join(dest, dst)
-                uploader.read_file(filename, dst)
+                uploader.read_file(filename, dst, resume=resume)
     else:
         raise Exception('You must specify a destination filename for each file you want to download.')
     log.info('All done!')
@@ -107,17 +152,19 @@ def operation_file(uploader, cmd, filename=''):
     """File operations"""
     if cmd == 'list':
         operation_list_files(uploader)
-    if cmd == 'do':
+    if cmd in ('do', 'remove', 'print'):
+        # all the files in one go
+        batch = uploader.batch()
         for path in filename:
-            uploader.file_do(path)
+            if cmd == 'do':
+                batch.file_do(path)
+            elif cmd == 'remove':
+                batch.file_remove(path)
+            else:
+                batch.file_print(path)
+        run_batch(uploader, batch)
     elif cmd == 'format':
         uploader.file_format()
-    elif cmd == 'remove':
-        for path in filename:
-            uploader.file_remove(path)
-    elif cmd == 'print':
-        for path in filename:
-            uploader.file_print(path)
     elif cmd == 'remove_all':
         uploader.file_remove_all()
 
@@ -135,8 +182,13 @@ def arg_auto_int(value):
     return int(value, 0)
 
 
-def main_func():
-    """Main function for cli"""
+def arg_baud(value):
+    """parsing function for --baud, an integer or auto"""
+    return value if value == BAUD_AUTO else arg_auto_int(value)
+
+
+def build_parser():
+    """The parser of the command line"""
     parser = argparse.ArgumentParser(
         description='NodeMCU Lua file uploader',
         prog='nodemcu-uploader'
@@ -171,8 +223,8 @@ def main_func():
 
     parser.add_argument(
         '--baud', '-b',
-        help='Serial port baudrate',
-        type=arg_auto_int,
+        help='Serial port baudrate. auto for the highest rate that works, it is remembered for the adapter and board',
+        type=arg_baud,
         default=Uploader.BAUD)
 
     parser.add_argument(
@@ -194,6 +246,59 @@ def main_func():
         default=Uploader.AUTOBAUD_TIME,
     )
 
+    parser.add_argument(
+        '--fleet', '-f',
+        help='Run the command on several devices at the same time. '
+             'A comma separated list of ports or auto for all ports matching --vid and --pid. '
+             'Downloads and backups end up in a folder per port.',
+        default=None)
+
+    parser.add_argument(
+        '--vid',
+        help='USB vendor id of the ports for --fleet auto',
+        type=arg_auto_int,
+        default=None)
+
+    parser.add_argument(
+        '--pid',
+        help='USB product id of the ports for --fleet auto',
+        type=arg_auto_int,
+        default=None)
+
+    parser.add_argument(
+        '--jobs', '-j',
+        help='Max number of devices handled at the same time with --fleet',
+        type=arg_auto_int,
+        default=None)
+
+    parser.add_argument(
+        '--stats',
+        help='Log what was sent, received and waited for in every operation',
+        action='store_const',
+        const='text',
+        default=None)
+
+    parser.add_argument(
+        '--stats-json',
+        help='Like --stats but printed as json on stdout',
+        dest='stats',
+        action='store_const',
+        const='json')
+
+    parser.add_argument(
+        '--no-progress',
+        help="Don't show progress bars for transfers, they are only shown on a terminal anyway",
+        dest='progress',
+        action='store_false',
+        default=True)
+
+    parser.add_argument(
+        '--no-daemon',
+        help="Open the port even if a daemon has it open, see the daemon command",
+        dest='daemon',
+        action='store_false',
+        default=True)
+
     subparsers = parser.add_subparsers(
         dest='operation',
         help='Run nodemcu-uploader {command} -h for additional help')
@@ -203,6 +308,12 @@ def main_func():
         help='Backup all the files on the nodemcu board')
     backup_parser.add_argument('path', help='Folder where to store the backup')
 
+    backup_parser.add_argument(
+        '--incremental', '-i',
+        help='Only download files that are new or changed since the last backup in the folder',
+        action='store_true',
+        default=False)
+
     upload_parser = subparsers.add_parser(
         'upload',
         help='Path to one or more files to be uploaded. Destination name will be the same as the file name.')
@@ -243,12 +354,57 @@ def main_func():
         default=False
     )
 
+    upload_parser.add_argument(
+        '--sync', '-s',
+        help='Only upload files that differ from the ones on the device',
+        action='store_true',
+        default=False
+    )
+
+    upload_parser.add_argument(
+        '--minify', '-m',
+        help='Minify lua files before upload. locals also gives local variables short names.',
+        action='store',
+        nargs='?',
+        choices=['none', 'basic', 'locals'],
+        const='basic',
+        default='none'
+    )
+
+    upload_parser.add_argument(
+        '--compress', '-z',
+        help='Compress files that benefit from it during transfer',
+        action='store_true',
+        default=False
+    )
+
+    upload_parser.add_argument(
+        '--window', '-w',
+        help='Number of blocks to send before waiting for the device to acknowledge them',
+        type=arg_auto_int,
+        default=Uploader.WINDOW
+    )
+
+    upload_parser.add_argument(
+        '--resume', '-u',
+        help='Complete files that an interrupted upload left on the device instead of starting over',
+        action='store_true',
+        default=False
+    )
+
     exec_parser = subparsers.add_parser(
         'exec',
         help='Path to one or more files to be executed line by line.')
 
     exec_parser.add_argument('filename', nargs='+', help='Lua file to execute.')
 
+    exec_parser.add_argument(
+        '--block', '-b',
+        help='Send each file at once and run it as one chunk with dofile. Much faster than line by line, '
+             'but locals are kept between lines and the first error ends it.',
+        action='store_true',
+        default=False)
+
     download_parser = subparsers.add_parser(
         'download',
         help='Path to one or more files to be downloaded. Destination name will be the same as the file name.')
@@ -258,6 +414,12 @@ def main_func():
         nargs='+',
         help='Lua file to download. Use colon to give alternate destination.')
 
+    download_parser.add_argument(
+        '--resume', '-u',
+        help='Complete files that an interrupted download left behind instead of starting over',
+        action='store_true',
+        default=False)
+
     file_parser = subparsers.add_parser(
         'file',
         help='File functions')
@@ -294,7 +456,24 @@ def main_func():
         choices=('list',)
     )
 
-    args = parser.parse_args()
+    daemon_parser = subparsers.add_parser(
+        'daemon',
+        help='Keep the connection to the device open in the background. '
+             'Commands for the same port go through it until it is stopped.'
+    )
+
+    daemon_parser.add_argument(
+        'cmd',
+        choices=('start', 'stop', 'status', 'run'),
+        help='run stays in the foreground'
+    )
+
+    return parser
+
+
+def main_func():
+    """Main function for cli"""
+    args = build_parser().parse_args()
 
     default_level = logging.INFO
     if args.silent:
@@ -304,7 +483,8 @@ def main_func():
 
     # formatter = logging.Formatter('%(message)s')
 
-    logging.basicConfig(level=default_level, format='%(message)s')
+    # with a fleet every thread is named after its port
+    logging.basicConfig(level=default_level, format='%(threadName)s: %(message)s' if args.fleet else '%(message)s')
 
     if args.operation == 'terminal':
         # uploader can not claim the port
@@ -313,6 +493,38 @@ def main_func():
     elif args.operation == 'port':
         operation_port(args)
         return
+    elif args.operation == 'daemon':
+        operation_daemon(args)
+        return
+
+    if args.fleet:
+        ports = fleet_ports(args.fleet, args.vid, args.pid)
+        if len(ports) == 0:
+            log.error('No ports found for the fleet')
+            sys.exit(1)
+        log.info('Running %s on %d devices', args.operation, len(ports))
+
+        def task(uploader, port):
+            if args.timeout:
+                uploader.set_timeout(args.timeout)
+            try:
+                # keep what is downloaded from different devices apart
+                run_operation(uploader, args, device_name(port))
+            finally:
+                report_stats(uploader, args.stats, port)
+
+        results = run_fleet(ports, task, args.jobs, baud=args.baud, start_baud=args.start_baud,
+                            autobaud_time=args.autobaud_time)
+        if not log_summary(results):
+            sys.exit(1)
+        return
+
+    if args.daemon and daemon.supported():
+        listener = ProgressBar(sys.stderr) if args.progress and not args.silent and sys.stderr.isatty() else None
+        message = {'argv': sys.argv[1:], 'cwd': os.getcwd(), 'level': default_level}
+        code = daemon.request(daemon.socket_path(args.port), message, listener)
+        if code is not None:
+            sys.exit(code)
 
     # let uploader user the default (short) timeout for establishing connection
     uploader = Uploader(args.port, args.baud, start_baud=args.start_baud, autobaud_time=args.autobaud_time)
@@ -321,17 +533,100 @@ def main_func():
     if args.timeout:
         uploader.set_timeout(args.timeout)
 
+    if args.progress and not args.silent and sys.stderr.isatty():
+        uploader.listeners.append(ProgressBar(sys.stderr))
+
+    try:
+        run_operation(uploader, args)
+    finally:
+        report_stats(uploader, args.stats)
+
+    # no uploader related commands after this point
+    uploader.close()
+
+
+def operation_daemon(args):
+    if not daemon.supported():
+        log.error('The daemon needs Unix sockets')
+        sys.exit(1)
+    path = daemon.socket_path(args.port)
+    if args.cmd == 'run':
+        session = daemon.Session(args.port, baud=args.baud, start_baud=args.start_baud,
+                                 autobaud_time=args.autobaud_time)
+        if not daemon.run(session, functools.partial(daemon_execute, settings=args), path):
+            sys.exit(1)
+    elif args.cmd == 'start':
+        # the same command line, in the foreground of a process of its own
+        argv = sys.argv[1:]
+        argv[len(argv) - 1 - argv[::-1].index('start')] = 'run'
+        if not daemon.start(path, argv):
+            sys.exit(1)
+    elif args.cmd == 'stop':
+        if not daemon.stop(path):
+            log.error('No daemon is running for %s', args.port)
+            sys.exit(1)
+    elif args.cmd == 'status':
+        if daemon.request(path, {'status': True}) is None:
+            log.info('No daemon is running for %s', args.port)
+            sys.exit(1)
+
+
+def daemon_execute(uploader, argv, cwd, out, settings=None):
+    """Runs the command line argv in the daemon, with its uploader, as if it
+    was run in cwd with out as stdout. settings are the arguments the daemon
+    was started with, a --timeout of argv is only for this command.
+    Returns True if the device was restarted and has to be synced again."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    settings = settings or parser.parse_args([])
+    # what argv asks for itself, the rest is the daemon's
+    parser.set_defaults(baud=None, start_baud=None, timeout=None)
+    given = parser.parse_args(argv)
+    for name in ('baud', 'start_baud'):
+        value = getattr(given, name)
+        if value is not None and value != getattr(settings, name):
+            log.warning('--%s %s is ignored, the daemon has the port at --%s %s. Stop it to change that',
+                        name, value, name, getattr(settings, name))
+    timeout = args.timeout if given.timeout is not None else settings.timeout
+    if timeout:
+        uploader.set_timeout(timeout)
+    try:
+        run_operation(uploader, args, cwd=cwd)
+    finally:
+        report_stats(uploader, args.stats, out=out)
+    return (args.operation == 'node' and args.ncmd == 'restart') or (args.operation == 'upload' and args.restart)
+
+
+def report_stats(uploader, how, port=None, out=None):
+    """Shows the stats of uploader as log lines if how is 'text' or prints them
+    as json, to out or else stdout, if it is 'json'"""
+    if how == 'text':
+        for line in uploader.stats.summary():
+            log.info(line)
+    elif how == 'json':
+        stats = uploader.stats.to_dict()
+        if port is not None:
+            stats['port'] = port
+        print(json.dumps(stats, sort_keys=True), file=out or sys.stdout)
+
+
+def run_operation(uploader, args, folder='', cwd=''):
+    """Runs the operation given on the command line.
+    Anything downloaded ends up in folder, if given.
+    Relative local paths are from cwd, if given, instead of the current directory."""
     if args.operation == 'upload':
+        if args.sync:
+            uploader.load_manifest()
         operation_upload(uploader, args.filename, args.verify, args.compile, args.dofile,
-                         args.restart)
+                         args.restart, args.window, args.sync, args.compress, args.minify, args.resume, cwd)
 
     elif args.operation == 'download':
-        operation_download(uploader, args.filename)
+        operation_download(uploader, args.filename, dest=os.path.join(cwd, folder), resume=args.resume)
 
     elif args.operation == 'exec':
         sources = args.filename
         for path in sources:
-            uploader.exec_file(path)
+            uploader.exec_file(os.path.join(cwd, path), args.block)
 
     elif args.operation == 'file':
         operation_file(uploader, args.cmd, args.filename)
@@ -345,8 +640,4 @@ def main_func():
             uploader.node_info()
 
     elif args.operation == 'backup':
-        uploader.backup(args.path)
-
-
-    # no uploader related commands after this point
-    uploader.close()
+        uploader.backup(os.path.join(cwd, args.path, folder), args.incremental)
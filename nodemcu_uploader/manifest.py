@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Host side cache of what files a device has"""
+
+import json
+import logging
+import os
+import time
+
+from .utils import cache_dir, write_json
+
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+__all__ = ['Manifest', 'BackupManifest']
+
+
+class Manifest(object):
+    """Last known size and sha1 of every file on one device, kept between runs
+    in a json file named after the device id. A file that is known to exist
+    but whose content is not known has None as sha1.
+    """
+
+    def __init__(self, device_id, path=None):
+        self.device_id = device_id
+        self.path = path or os.path.join(cache_dir(), 'devices', device_id + '.json')
+        self.files = {}
+        self.load()
+
+    def load(self):
+        """Read the manifest from disk, a missing or broken file is an empty manifest"""
+        try:
+            with open(self.path, 'r') as fil:
+                self._read(json.load(fil))
+        except (IOError, OSError, ValueError):
+            self._read({})
+
+    def _read(self, data):
+        self.files = dict((name, tuple(entry)) for name, entry in data.get('files', {}).items())
+
+    def to_dict(self):
+        return {'device': self.device_id, 'files': self.files}
+
+    def save(self):
+        """Write the manifest to disk"""
+        write_json(self.path, self.to_dict())
+
+    def validate(self, sizes):
+        """Compare with the {name: size} listing of the device. Files with a
+        different size lose their sha1 and files that are gone are dropped."""
+        files = {}
+        for name, size in sizes.items():
+            entry = self.files.get(name)
+            if entry is not None and entry[0] == size:
+                files[name] = entry
+            else:
+                files[name] = (size, None)
+        if files != self.files:
+            log.debug('manifest for %s did not match the device', self.device_id)
+        self.files = files
+
+    def get(self, name):
+        """(size, sha1) of name or None if it doesn't exist on the device"""
+        return self.files.get(name)
+
+    def known(self, name):
+        """True if it is known whether name exists and what it contains"""
+        entry = self.files.get(name)
+        return entry is None or entry[1] is not None
+
+    def update(self, name, size=None, sha1=None):
+        """Record that name exists with the given size and sha1, if known"""
+        self.files[name] = (size, sha1)
+
+    def remove(self, name):
+        """Record that name doesn't exist anymore"""
+        self.files.pop(name, None)
+
+    def clear(self):
+        """Record that there are no files"""
+        self.files = {}
+
+
+class BackupManifest(Manifest):
+    """Size and sha1 of every file in a backup folder, as they were on the
+    device, kept in the folder itself. Files that are gone from the device
+    are kept in the folder and recorded in self.deleted with their size,
+    sha1 and when the backup found out.
+    """
+    FILENAME = '.nodemcu-backup.json'
+
+    def __init__(self, folder, device_id):
+        self.deleted = {}
+        super(BackupManifest, self).__init__(device_id, os.path.join(folder, self.FILENAME))
+
+    def _read(self, data):
+        super(BackupManifest, self)._read(data)
+        self.deleted = dict((name, tuple(entry)) for name, entry in data.get('deleted', {}).items())
+        if data.get('device', self.device_id) != self.device_id:
+            log.warning('the backup in %s is of device %s, starting over', os.path.dirname(self.path), data['device'])
+            self.files = {}
+            self.deleted = {}
+
+    def to_dict(self):
+        data = super(BackupManifest, self).to_dict()
+        data['deleted'] = self.deleted
+        return data
+
+    def update(self, name, size=None, sha1=None):
+        super(BackupManifest, self).update(name, size, sha1)
+        self.deleted.pop(name, None)
+
+    def remove(self, name):
+        """Record that name was deleted on the device"""
+        entry = self.files.pop(name, None)
+        if entry is not None:
+            self.deleted[name] = entry + (time.strftime('%Y-%m-%d %H:%M:%S'),)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Minifier for lua source.
+
+Comments are removed and whitespace is only kept where two tokens would
+otherwise run together. Strings are never touched. Optionally local
+variables get short names. That is done with a light weight scope analysis
+and a name is only renamed if every use of it resolves to a local, so any
+global or table field with the same name is left alone.
+"""
+
+import re
+
+__all__ = ['minify', 'MinifyException']
+
+KEYWORDS = frozenset((
+    'and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for', 'function', 'goto', 'if', 'in',
+    'local', 'nil', 'not', 'or', 'repeat', 'return', 'then', 'true', 'until', 'while'))
+
+NAME, KEYWORD, NUMBER, STRING, OP = 'name', 'keyword', 'number', 'string', 'op'
+
+_SPACE = re.compile(r'\s+')
+_LINE_COMMENT = re.compile(r'--[^\n]*')
+_LONG_OPEN = re.compile(r'\[(=*)\[')
+_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_WORD = re.compile(r'[A-Za-z0-9_]')
+_NUMBER = re.compile(r'0[xX][0-9a-fA-F]*(\.[0-9a-fA-F]*)?([pP][+-]?[0-9]+)?|'
+                     r'([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?')
+_QUOTED = re.compile(r'"(\\(.|\n)|[^"\\\n])*"|' r"'(\\(.|\n)|[^'\\\n])*'")
+_OPS = ('...', '..', '==', '~=', '<=', '>=', '<<', '>>', '//', '::')
+
+# a name or keyword can be a statement of its own after these
+_ENDS_EXPRESSION = frozenset((')', ']', '}', '...', 'end', 'true', 'false', 'nil'))
+# blocks and brackets that scopes and table constructors are tracked with
+_CLOSES = {'end': ('function', 'do', 'then', 'else'), ')': ('(',), ']': ('[',), '}': ('{',)}
+
+
+class MinifyException(Exception):
+    pass
+
+
+def _tokenize(source):
+    """Yields (kind, text) for every token, comments and whitespace are dropped"""
+    pos = 0
+    size = len(source)
+    while pos < size:
+        match = _SPACE.match(source, pos)
+        if match:
+            pos = match.end()
+            continue
+        if source.startswith('--', pos):
+            long_open = _LONG_OPEN.match(source, pos + 2)
+            if long_open:
+                pos = _long_end(source, long_open, 'comment')
+            else:
+                pos = _LINE_COMMENT.match(source, pos).end()
+            continue
+        long_open = _LONG_OPEN.match(source, pos)
+        if long_open:
+            end = _long_end(source, long_open, 'string')
+            yield STRING, source[pos:end]
+            pos = end
+            continue
+        char = source[pos]
+        if char in '"\'':
+            match = _QUOTED.match(source, pos)
+            if not match:
+                raise MinifyException('Unfinished string at {0}'.format(pos))
+            yield STRING, match.group()
+            pos = match.end()
+            continue
+        match = _NUMBER.match(source, pos)
+        if match and match.end() > pos and (char.isdigit() or source[pos + 1:pos + 2].isdigit()):
+            yield NUMBER, match.group()
+            pos = match.end()
+            continue
+        match = _NAME.match(source, pos)
+        if match:
+            text = match.group()
+            yield (KEYWORD if text in KEYWORDS else NAME), text
+            pos = match.end()
+            continue
+        for op in _OPS:
+            if source.startswith(op, pos):
+                yield OP, op
+                pos += len(op)
+                break
+        else:
+            yield OP, char
+            pos += 1
+
+
+def _long_end(source, long_open, what):
+    close = ']' + long_open.group(1) + ']'
+    end = source.find(close, long_open.end())
+    if end == -1:
+        raise MinifyException('Unfinished long {0} at {1}'.format(what, long_open.start()))
+    return end + len(close)
+
+
+def _separate(left, right):
+    """True if the two tokens would read as something else without space between"""
+    if _WORD.match(left[-1]) and _WORD.match(right[0]):
+        # lua reads numbers greedily, so 1 and local is not 1local
+        return True
+    try:
+        return [text for _, text in _tokenize(left + right)] != [left, right]
+    except MinifyException:
+        return True
+
+
+class _Scope(object):
+    def __init__(self, kind):
+        self.kind = kind
+        self.names = {}
+
+
+class _Resolver(object):
+    """Works out which name tokens are local variables.
+    Every local declaration gets an id and 'uses' maps token index to that id.
+    Names used as globals are collected in 'globals'."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.stack = [_Scope('chunk')]
+        self.decl_count = 0
+        self.uses = {}
+        self.decl_names = {}
+        self.globals = set()
+        # locals whose 'local a = ...' statement has not ended yet, (depth, [(index, name)])
+        self.pending = []
+        # loop variables waiting for the 'do' of their for
+        self.loop_vars = []
+        self.params = None
+        # declarations that must keep their name
+        self.fixed = set()
+
+    def text(self, index):
+        return self.tokens[index][1] if index < len(self.tokens) else None
+
+    def declare(self, index, name):
+        self.decl_count += 1
+        scope = next(s for s in reversed(self.stack) if s.kind not in ('(', '[', '{'))
+        scope.names[name] = self.decl_count
+        self.decl_names[self.decl_count] = name
+        self.uses[index] = self.decl_count
+
+    def resolve(self, index, name):
+        for scope in reversed(self.stack):
+            if name in scope.names:
+                self.uses[index] = scope.names[name]
+                return
+        self.globals.add(name)
+
+    def pop(self, token):
+        opens = _CLOSES.get(token)
+        if len(self.stack) < 2 or (opens and self.stack[-1].kind not in opens):
+            raise MinifyException('Unbalanced `{0}`'.format(token))
+        self.stack.pop()
+
+    def run(self):
+        tokens = self.tokens
+        prev = (None, None)
+        i = 0
+        while i < len(tokens):
+            kind, text = tokens[i]
+            self.end_pending(prev, kind, text)
+            after = tokens[i + 1] if i + 1 < len(tokens) else (None, None)
+            if kind == NAME:
+                self.name(i, text, prev, after)
+            elif kind == KEYWORD:
+                i = self.keyword(i, text)
+            elif kind == OP:
+                self.op(text)
+            prev = tokens[i]
+            i += 1
+
+    def end_pending(self, prev, kind, text):
+        """A local statement ends where an expression is followed by the start of a new statement"""
+        while self.pending and self.pending[-1][0] > len(self.stack):
+            # the scope ended with the statement, uses were seen as globals
+            self.pending.pop()
+        while self.pending and self.pending[-1][0] == len(self.stack):
+            ends = prev[0] in (NAME, NUMBER, STRING) or prev[1] in _ENDS_EXPRESSION
+            starts = kind in (NAME, None) or (kind == KEYWORD and text not in ('and', 'or')) or text == ';'
+            if not (ends and starts):
+                return
+            for index, name in self.pending.pop()[1]:
+                self.declare(index, name)
+
+    def name(self, i, text, prev, after):
+        if prev[1] in ('.', ':', '::', 'goto') or after[1] == '::':
+            # fields, methods and labels are not variables
+            return
+        if after[1] == '=' and self.stack[-1].kind == '{':
+            # key in a table constructor
+            return
+        if self.params is not None:
+            self.params.append((i, text))
+            return
+        self.resolve(i, text)
+
+    def keyword(self, i, text):
+        tokens = self.tokens
+        if text == 'local':
+            if self.text(i + 1) == 'function':
+                # visible inside its own body
+                self.declare(i + 2, self.text(i + 2))
+                return i
+            names = []
+            j = i + 1
+            while j < len(tokens) and tokens[j][0] == NAME:
+                names.append((j, tokens[j][1]))
+                j += 1
+                if self.text(j) == '<':
+                    # attribute like <const>
+                    j += 3
+                if self.text(j) != ',':
+                    break
+                j += 1
+            if self.text(j) == '=':
+                self.pending.append((len(self.stack), names))
+            else:
+                for index, name in names:
+                    self.declare(index, name)
+            return j - 1
+        if text == 'function':
+            self.stack.append(_Scope('function'))
+            j = i + 1
+            method = False
+            while self.text(j) != '(':
+                if j >= len(tokens):
+                    raise MinifyException('Function without parameters')
+                if tokens[j][0] == NAME and tokens[j - 1][1] not in ('.', ':'):
+                    # the variable a function statement assigns to is outside of it
+                    self.stack.pop()
+                    self.resolve(j, tokens[j][1])
+                    self.stack.append(_Scope('function'))
+                method = method or tokens[j][1] == ':'
+                j += 1
+            if method:
+                # the implicit self can't get another name
+                self.decl_count += 1
+                self.fixed.add(self.decl_count)
+                self.stack[-1].names['self'] = self.decl_count
+            self.params = []
+            self.stack.append(_Scope('('))
+            return j
+        if text in ('for', 'while'):
+            self.stack.append(_Scope(text))
+            if text == 'for':
+                j = i + 1
+                while j < len(tokens) and tokens[j][0] == NAME:
+                    self.loop_vars.append((j, tokens[j][1]))
+                    j += 1
+                    if self.text(j) == ',':
+                        j += 1
+                return j - 1
+            return i
+        if text == 'do':
+            if self.stack[-1].kind in ('for', 'while'):
+                self.stack[-1].kind = 'do'
+                for index, name in self.loop_vars:
+                    self.declare(index, name)
+                self.loop_vars = []
+            else:
+                self.stack.append(_Scope('do'))
+        elif text in ('if', 'elseif'):
+            if text == 'elseif':
+                self.pop('end')
+            self.stack.append(_Scope('if'))
+        elif text == 'then':
+            if self.stack[-1].kind != 'if':
+                raise MinifyException('Unexpected `then`')
+            self.stack[-1].kind = 'then'
+        elif text == 'else':
+            self.pop('end')
+            self.stack.append(_Scope('else'))
+        elif text == 'repeat':
+            self.stack.append(_Scope('do'))
+        elif text == 'until':
+            # locals of the block are visible in the condition, resolving them
+            # as globals afterwards only means they are left as they are
+            self.pop('end')
+        elif text == 'end':
+            self.pop('end')
+        return i
+
+    def op(self, text):
+        if text in ('(', '[', '{'):
+            self.stack.append(_Scope(text))
+        elif text in (')', ']', '}'):
+            self.pop(text)
+            if text == ')' and self.params is not None:
+                # parameters belong to the function scope
+                for index, name in self.params:
+                    if name != '...':
+                        self.declare(index, name)
+                self.params = None
+
+
+def _short_names(taken):
+    """Yields the shortest names that are not keywords or taken"""
+    first = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_'
+    rest = first + '0123456789'
+    length = 1
+    while True:
+        names = ['']
+        for pos in range(length):
+            chars = first if pos == 0 else rest
+            names = [name + char for name in names for char in chars]
+        for name in names:
+            if name not in KEYWORDS and name not in taken:
+                yield name
+        length += 1
+
+
+def _rename(tokens, keep):
+    resolver = _Resolver(tokens)
+    resolver.run()
+    taken = set(text for kind, text in tokens if kind == NAME) | set(keep)
+    # most used first so they get the shortest names
+    counts = {}
+    for decl in resolver.uses.values():
+        counts[decl] = counts.get(decl, 0) + 1
+    skip = resolver.globals | set(keep)
+    renames = {}
+    names = _short_names(taken)
+    for decl in sorted(counts, key=lambda d: -counts[d]):
+        if decl in resolver.fixed or resolver.decl_names[decl] in skip:
+            continue
+        renames[decl] = next(names)
+    result = list(tokens)
+    for index, decl in resolver.uses.items():
+        if decl in renames:
+            result[index] = (NAME, renames[decl])
+    return result
+
+
+def minify(source, rename=False, keep=(), max_line=None):
+    """Returns a minified version of the lua in source.
+    With rename local variables get short names, except those in keep.
+    With max_line, lines are broken between tokens to stay below that length.
+    """
+    shebang = ''
+    if source.startswith('#'):
+        shebang, _, source = source.partition('\n')
+        shebang += '\n'
+    tokens = list(_tokenize(source))
+    if rename:
+        tokens = _rename(tokens, keep)
+    lines = []
+    line = ''
+    prev = None
+    for kind, text in tokens:
+        glue = ''
+        if prev is not None and _separate(prev, text):
+            glue = ' '
+        # never break before '(' since that is ambiguous to lua
+        if max_line and prev is not None and len(line) + len(glue) + len(text) > max_line and text != '(':
+            lines.append(line)
+            line = ''
+            glue = ''
+        line += glue + text
+        prev = text
+    lines.append(line)
+    return shebang + '\n'.join(lines)
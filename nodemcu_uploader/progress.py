@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Progress of file transfers.
+
+Every function in Uploader.listeners, or AsyncUploader.listeners, is called
+with a Progress when a transfer starts, for every frame the device has taken
+or sent and when it ends. Nothing is done if there are no listeners.
+"""
+
+import sys
+import time
+from collections import namedtuple
+
+__all__ = ['Progress', 'ProgressBar', 'START', 'FRAME', 'END']
+
+START = 'start'
+FRAME = 'frame'
+END = 'end'
+
+# event is START, FRAME or END, operation is write_file or download_file,
+# done and total are payload bytes, total is None when it isn't known and
+# elapsed is the seconds since the start.
+Progress = namedtuple('Progress', ['event', 'operation', 'name', 'done', 'total', 'elapsed'])
+
+
+def notify(listeners, event, operation, name, done, total, start):
+    """Calls every listener with the progress"""
+    progress = Progress(event, operation, name, done, total, time.time() - start)
+    for listener in listeners:
+        listener(progress)
+
+
+def _size(count):
+    if count < 1024:
+        return '{0:.0f} B'.format(count)
+    if count < 1024 * 1024:
+        return '{0:.1f} KB'.format(count / 1024.0)
+    return '{0:.1f} MB'.format(count / 1024.0 / 1024.0)
+
+
+class ProgressBar(object):
+    """A listener that draws a progress bar with the throughput on a terminal"""
+    WIDTH = 30
+    # seconds between redraws
+    INTERVAL = 0.1
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self._drawn = 0
+        # what was already there when the transfer started, a resumed
+        # transfer only moves the rest in this session
+        self._skipped = 0
+
+    def __call__(self, progress):
+        now = time.time()
+        if progress.event == START:
+            self._skipped = progress.done
+        if progress.event == FRAME and now - self._drawn < self.INTERVAL:
+            return
+        self._drawn = now
+        moved = progress.done - self._skipped
+        rate = moved / progress.elapsed if progress.elapsed > 0 else 0
+        if progress.total:
+            filled = self.WIDTH * progress.done // progress.total
+            percent = 100 * progress.done // progress.total
+            bar = '[{0}{1}] {2:3d}%'.format('#' * filled, ' ' * (self.WIDTH - filled), percent)
+            if rate and progress.event != END:
+                bar += ' ETA {0:.0f}s'.format((progress.total - progress.done) / rate)
+        else:
+            bar = _size(progress.done)
+        line = '\r{0} {1} {2}/s'.format(progress.name, bar, _size(rate))
+        self.stream.write(line + ('\n' if progress.event == END else '\x1b[K'))
+        self.stream.flush()
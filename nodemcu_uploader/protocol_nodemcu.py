@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""pyserial handler for nodemcu:// URLs that connect to an emulated device.
+
+    nodemcu://[name][?latency=<seconds>&throttle=1&heap=<bytes>&max_baud=<rate>&lua=1]
+
+serialutils adds this package to serial.protocol_handler_packages so that
+serial.serial_for_url() finds it. See emulator for the options.
+"""
+
+import time
+
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
+
+from serial.serialutil import SerialBase, SerialException, Timeout, to_bytes
+
+try:
+    from serial.serialutil import PortNotOpenError
+except ImportError:
+    # pySerial 3.4 only has an instance, portNotOpenError
+    class PortNotOpenError(SerialException):
+        def __init__(self):
+            super(PortNotOpenError, self).__init__('Attempting to use a port that is not open')
+
+from .emulator import Device, LuaDevice, Link, device
+
+__all__ = ['Serial']
+
+
+class Serial(SerialBase):
+    """Serial port of an emulated NodeMCU"""
+
+    def open(self):
+        if self._port is None:
+            raise SerialException('Port must be configured before it can be used.')
+        if self.is_open:
+            raise SerialException('Port is already open.')
+        self._link = self.from_url(self.port)
+        self._buffer = bytearray()
+        self._sent = 0.0
+        self.is_open = True
+
+    def from_url(self, url):
+        """Returns a Link to the device of url"""
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'nodemcu':
+            raise SerialException('expected a string in the form "nodemcu://[name][?options]", not {0!r}'.format(url))
+        options = {}
+        try:
+            for option, values in urlparse.parse_qs(parts.query, True).items():
+                if option == 'latency':
+                    options['latency'] = float(values[0])
+                elif option == 'throttle':
+                    options['throttle'] = values[0] not in ('', '0', 'false')
+                elif option == 'heap':
+                    options['heap'] = int(values[0])
+                elif option == 'max_baud':
+                    options['max_baud'] = int(values[0])
+                elif option == 'lua':
+                    options['lua'] = values[0] not in ('', '0', 'false')
+                else:
+                    raise ValueError('unknown option: {0!r}'.format(option))
+        except ValueError as e:
+            raise SerialException('expected a string in the form "nodemcu://[name][?options]": {0}'.format(e))
+        kwargs = {'heap': options.pop('heap', Device.HEAP), 'max_baud': options.pop('max_baud', None)}
+        lua = options.pop('lua', False)
+        dev = device(parts.netloc, lua, **kwargs) if parts.netloc else (LuaDevice if lua else Device)(**kwargs)
+        return Link(dev, **options)
+
+    def close(self):
+        self.is_open = False
+
+    def _reconfigure_port(self):
+        """The baudrate is passed with every write, nothing to do here"""
+
+    def _pull(self):
+        self._buffer += self._link.read()
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        self._pull()
+        return len(self._buffer)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+        timeout = Timeout(self._timeout)
+        self._pull()
+        while len(self._buffer) < size and not timeout.expired() and not timeout.is_non_blocking:
+            arrival = self._link.next_arrival()
+            if arrival is None:
+                # nothing is on the way
+                wait = timeout.time_left()
+                if wait is None:
+                    raise SerialException('The emulated device will never answer')
+            else:
+                wait = arrival - time.time()
+                if not timeout.is_infinite:
+                    wait = min(wait, timeout.time_left())
+            time.sleep(max(0.0, wait))
+            self._pull()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+        data = to_bytes(data)
+        self._sent = self._link.write(data, self._baudrate)
+        return len(data)
+
+    def flush(self):
+        """Waits until everything is sent"""
+        if not self.is_open:
+            raise PortNotOpenError()
+        time.sleep(max(0.0, self._sent - time.time()))
+
+    def reset_input_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        self._pull()
+        self._buffer = bytearray()
+
+    def reset_output_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+    @property
+    def out_waiting(self):
+        return 0
+
+    def _update_rts_state(self):
+        pass
+
+    def _update_dtr_state(self):
+        pass
+
+    def _update_break_state(self):
+        pass
+
+    @property
+    def cts(self):
+        return False
+
+    @property
+    def dsr(self):
+        return False
+
+    @property
+    def ri(self):
+        return False
+
+    @property
+    def cd(self):
+        return False
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Structured queries of the state of the device.
+
+    state = uploader.query('files', 'heap', 'hw')
+    state['heap'], state['files']['init.lua'], state['hw']['chip_id']
+
+The device puts what was asked for in a table and prints it encoded, with
+sjson if the firmware has it or else with lengths in front of every value,
+so that one exchange returns all of it and nothing is scraped from text
+meant for people. File names can have any characters.
+"""
+
+import json
+
+from .exceptions import BadResponseException
+from .luacode import QUERY
+
+__all__ = ['FIELDS', 'INFO_GROUPS', 'query_code', 'parse_query', 'encode', 'decode']
+
+# what can be asked for and the Lua expression that has it
+FIELDS = {
+    'files': 'file.list()',
+    'heap': 'node.heap()',
+    'chip_id': 'node.chipid()',
+    'flash_id': 'node.flashid()',
+    # {name: {size=, sha1=}} of every file
+    'hashes': "(function() local t={} for k,v in pairs(file.list()) do "
+              "t[k]={size=v,sha1=crypto.toHex(crypto.fhash('sha1',k))} end return t end)()",
+    'hw': "node.info('hw')",
+    'sw_version': "node.info('sw_version')",
+    'build_config': "node.info('build_config')",
+}
+
+INFO_GROUPS = ('hw', 'sw_version', 'build_config')
+
+# what QUERY prints around the encoded table
+START = '\x02'
+END = '\x03'
+
+
+def query_code(fields):
+    """The Lua code that prints the encoded table of fields"""
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError('Unknown field ' + field)
+    return QUERY.format(fields=','.join('{0}={1}'.format(field, FIELDS[field]) for field in fields))
+
+
+def encode(value):
+    """Encodes value like QUERY does without sjson"""
+    if isinstance(value, dict):
+        return 't' + ''.join(encode(str(k)) + encode(v) for k, v in value.items()) + 'e'
+    if isinstance(value, bool):
+        kind, text = 'b', str(value).lower()
+    elif isinstance(value, (int, float)):
+        kind, text = 'n', str(value)
+    else:
+        kind, text = 's', str(value)
+    return '{0}{1}:{2}'.format(kind, len(text), text)
+
+
+def _decode(data, pos):
+    """The value at pos of what encode() returns and where the next one starts"""
+    kind = data[pos]
+    if kind == 't':
+        table = {}
+        pos += 1
+        while data[pos] != 'e':
+            key, pos = _decode(data, pos)
+            table[key], pos = _decode(data, pos)
+        return table, pos + 1
+    colon = data.index(':', pos)
+    end = colon + 1 + int(data[pos + 1:colon])
+    text = data[colon + 1:end]
+    if kind == 'n':
+        try:
+            return int(text), end
+        except ValueError:
+            return float(text), end
+    if kind == 'b':
+        return text == 'true', end
+    return text, end
+
+
+def decode(data):
+    """The value that encode() returned data for"""
+    return _decode(data, 0)[0]
+
+
+def parse_query(res):
+    """The table printed by the code from query_code()"""
+    start = res.find(START)
+    end = res.rfind(END)
+    if start == -1 or end < start:
+        raise BadResponseException('Bad query response', START + '...' + END, res)
+    data = res[start + 1:end]
+    try:
+        if data.startswith('{'):
+            # sjson has no way to tell an empty table from an empty list
+            return dict((k, {} if v == [] else v) for k, v in json.loads(data).items())
+        return decode(data)
+    except (IndexError, ValueError):
+        raise BadResponseException('Bad query response', START + '...' + END, res)
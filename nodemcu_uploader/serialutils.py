@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
 
+import asyncio
+import time
 from platform import system
 from os import environ
+import serial
 from serial.tools import list_ports
 
+# nodemcu:// ports of the emulator, see protocol_nodemcu
+if 'nodemcu_uploader' not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append('nodemcu_uploader')
+
 
 def default_port(sysname=system(), detect=True):
     """This returns the default port used for different systems if SERIALPORT env variable is not set"""
@@ -31,3 +38,178 @@ def default_port(sysname=system(), detect=True):
             pass
 
     return environ.get('SERIALPORT', system_default)
+
+
+def find_ports(vid=None, pid=None):
+    """Returns the devices of all serial ports matching vid and pid, if given"""
+    ports = list_ports.comports(include_links=False)
+    return sorted(p.device for p in ports
+                  if (vid is None or p.vid == vid) and (pid is None or p.pid == pid))
+
+
+def adapter_id(port):
+    """Identifies the USB serial adapter of port by vid, pid and serial number,
+    or its place on the bus if it has none. Anything else is the port itself."""
+    for p in list_ports.comports(include_links=False):
+        if p.device == port and p.vid is not None:
+            return '{0:04x}:{1:04x}:{2}'.format(p.vid, p.pid, p.serial_number or p.location or port)
+    return port
+
+
+class BufferedReader(object):
+    """Reads from a serial port in bulk and hands out the data to parsers.
+    Whatever is waiting on the port is drained in one read and kept until it
+    is consumed, so nothing is ever read one byte at a time. When nothing is
+    waiting the reader blocks in the port for at most 'poll' seconds instead
+    of spinning, which keeps many readers in one process cheap.
+    """
+    POLL = 0.05
+
+    def __init__(self, port, poll=POLL):
+        self._port = port
+        self._buf = bytearray()
+        # start of the data that is not consumed yet
+        self._pos = 0
+        # setting the timeout reconfigures the port so only do it once
+        if system() != 'Windows':
+            port.timeout = poll
+
+    def __len__(self):
+        return len(self._buf) - self._pos
+
+    def _fill(self):
+        """Drains the port into the buffer, waits for one byte if it is empty"""
+        try:
+            waiting = self._port.in_waiting
+        except AttributeError:
+            # pySerial 2.
+            waiting = self._port.inWaiting()
+        data = self._port.read(waiting or 1)
+        if self._pos and self._pos >= len(self._buf) // 2:
+            # compact when half of the buffer has been consumed
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += data
+        return len(data)
+
+    def _take(self, end):
+        data = bytes(self._buf[self._pos:end])
+        self._pos = end
+        return data
+
+    def read(self, size, timeout):
+        """Returns 'size' bytes or less if they didn't arrive within timeout"""
+        end = time.time() + timeout
+        while len(self) < size and time.time() <= end:
+            self._fill()
+        return self._take(self._pos + min(size, len(self)))
+
+    def read_until(self, expected, timeout):
+        """Returns everything up to and including 'expected' or whatever
+        arrived within timeout if it never showed up"""
+        end = time.time() + timeout
+        # how much of the unconsumed data is known not to contain a match
+        searched = 0
+        while True:
+            found = self._buf.find(expected, self._pos + searched)
+            if found != -1:
+                return self._take(found + len(expected))
+            searched = max(0, len(self) - len(expected) + 1)
+            if time.time() > end:
+                return self._take(len(self._buf))
+            self._fill()
+
+    def clear(self):
+        """Forgets everything buffered"""
+        self._buf = bytearray()
+        self._pos = 0
+
+
+class AsyncTransport(BufferedReader):
+    """BufferedReader for asyncio that also writes. The port is set to never block.
+    Instead the event loop tells when it can be read or written, or for ports without
+    a file descriptor, like loop://, it is polled every 'poll' seconds. Many of these
+    can share one loop without a thread each.
+    """
+    POLL = 0.005
+
+    def __init__(self, port, poll=POLL):
+        super(AsyncTransport, self).__init__(port, poll)
+        self.poll = poll
+        port.timeout = 0
+        self._loop = asyncio.get_event_loop()
+        self._readable = asyncio.Event()
+        self._fd = None
+        try:
+            fd = port.fileno()
+            self._loop.add_reader(fd, self._on_readable)
+        except (AttributeError, NotImplementedError, OSError):
+            # loop:// and the like or a loop that can't watch serial ports, e.g. on Windows
+            return
+        self._fd = fd
+        port.write_timeout = 0
+
+    def _on_readable(self):
+        # the loop keeps calling as long as there is something to read so take it all
+        self._fill()
+        self._readable.set()
+
+    async def _wait(self, end):
+        """Waits until more data may have arrived or end"""
+        remaining = end - time.time()
+        if remaining <= 0:
+            return
+        if self._fd is None:
+            await asyncio.sleep(min(self.poll, remaining))
+            self._fill()
+            return
+        self._readable.clear()
+        try:
+            await asyncio.wait_for(self._readable.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+    async def read(self, size, timeout):
+        """Returns 'size' bytes or less if they didn't arrive within timeout"""
+        end = time.time() + timeout
+        if self._fd is None:
+            self._fill()
+        while len(self) < size and time.time() <= end:
+            await self._wait(end)
+        return self._take(self._pos + min(size, len(self)))
+
+    async def read_until(self, expected, timeout):
+        """Returns everything up to and including 'expected' or whatever
+        arrived within timeout if it never showed up"""
+        end = time.time() + timeout
+        if self._fd is None:
+            self._fill()
+        searched = 0
+        while True:
+            found = self._buf.find(expected, self._pos + searched)
+            if found != -1:
+                return self._take(found + len(expected))
+            searched = max(0, len(self) - len(expected) + 1)
+            if time.time() > end:
+                return self._take(len(self._buf))
+            await self._wait(end)
+
+    async def write(self, data):
+        """Writes all of data, waiting for the port to take it"""
+        data = memoryview(data)
+        while len(data) > 0:
+            if self._fd is not None:
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+            written = self._port.write(data)
+            data = data[len(data) if written is None else written:]
+
+    def close(self):
+        """Stops watching the port, it has to be closed separately"""
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Statistics of what an Uploader sends, receives and waits for.
+
+Every public operation of the Uploader is recorded with the bytes on the
+wire, the payload, the frames and how long was spent waiting for the device.
+Comparing the time waiting with the time the bytes need on the wire tells
+if a slow transfer is the device, the host or the link.
+"""
+
+import functools
+import time
+
+__all__ = ['Histogram', 'Counters', 'Stats', 'recorded']
+
+
+class Histogram(object):
+    """Counts of durations, in buckets of powers of two from 1 ms"""
+    BUCKETS = tuple(0.001 * 2 ** i for i in range(14))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        index = 0
+        while index < len(self.BUCKETS) and seconds > self.BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def to_dict(self):
+        buckets = dict(('<={0:g}'.format(limit), count) for limit, count in zip(self.BUCKETS, self.counts) if count)
+        if self.counts[-1]:
+            buckets['>{0:g}'.format(self.BUCKETS[-1])] = self.counts[-1]
+        return {'count': self.count, 'total': self.total, 'max': self.max, 'buckets': buckets}
+
+
+class Counters(object):
+    """What happened during one operation, or all of them"""
+
+    def __init__(self, name, target=None):
+        self.name = name
+        self.target = target
+        self.start = time.time()
+        self.seconds = 0.0
+        # everything written to and read from the port
+        self.written = 0
+        self.read = 0
+        # the file content that was transferred
+        self.payload = 0
+        self.frames = 0
+        self.timeouts = 0
+        self.bad_responses = 0
+        # time spent waiting for the device, by what was waited for
+        self.waits = {}
+
+    def wait(self, kind, seconds):
+        if kind not in self.waits:
+            self.waits[kind] = Histogram()
+        self.waits[kind].add(seconds)
+
+    @property
+    def throughput(self):
+        """Payload bytes per second"""
+        return self.payload / self.seconds if self.seconds else 0.0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'target': self.target,
+            'seconds': self.seconds,
+            'written': self.written,
+            'read': self.read,
+            'payload': self.payload,
+            'frames': self.frames,
+            'timeouts': self.timeouts,
+            'bad_responses': self.bad_responses,
+            'throughput': self.throughput,
+            'waits': dict((kind, hist.to_dict()) for kind, hist in self.waits.items()),
+        }
+
+    def summary(self):
+        """One line for a log"""
+        waits = ', '.join('{0} {1} in {2:.3f}s (max {3:.3f}s)'.format(hist.count, kind, hist.total, hist.max)
+                          for kind, hist in sorted(self.waits.items()))
+        line = '{0}{1}: {2:.3f}s, {3} bytes written, {4} read'.format(
+            self.name, ' ' + self.target if self.target else '', self.seconds, self.written, self.read)
+        if self.payload:
+            line += ', {0} payload in {1} frames, {2:.0f} B/s'.format(self.payload, self.frames, self.throughput)
+        if self.timeouts or self.bad_responses:
+            line += ', {0} timeouts, {1} bad responses'.format(self.timeouts, self.bad_responses)
+        if waits:
+            line += '. Waited for ' + waits
+        return line
+
+
+class Stats(object):
+    """Counters of every operation of an Uploader and the total"""
+
+    def __init__(self):
+        self.total = Counters('total')
+        self.operations = []
+        # the operations in progress, an operation can be part of another
+        self._active = []
+
+    def begin(self, name, target=None):
+        counters = Counters(name, target)
+        self._active.append(counters)
+        return counters
+
+    def end(self, counters):
+        counters.seconds = time.time() - counters.start
+        self._active.remove(counters)
+        self.operations.append(counters)
+
+    def _all(self):
+        return [self.total] + self._active
+
+    def written(self, size):
+        for counters in self._all():
+            counters.written += size
+
+    def read(self, size):
+        for counters in self._all():
+            counters.read += size
+
+    def payload(self, size, frames=0):
+        for counters in self._all():
+            counters.payload += size
+            counters.frames += frames
+
+    def wait(self, kind, seconds):
+        for counters in self._all():
+            counters.wait(kind, seconds)
+
+    def timeout(self):
+        for counters in self._all():
+            counters.timeouts += 1
+
+    def bad_response(self):
+        for counters in self._all():
+            counters.bad_responses += 1
+
+    def to_dict(self):
+        self.total.seconds = time.time() - self.total.start
+        return {'total': self.total.to_dict(), 'operations': [op.to_dict() for op in self.operations]}
+
+    def summary(self):
+        """Lines for a log, one per operation and the total"""
+        self.total.seconds = time.time() - self.total.start
+        return [op.summary() for op in self.operations] + [self.total.summary()]
+
+
+def recorded(flow):
+    """Decorator for the flows of UploaderCore that count as an operation in
+    self.stats. The operation has the name of the public method, the flow
+    without the underscore. The first argument, if a str, is the target."""
+    name = flow.__name__.lstrip('_')
+
+    @functools.wraps(flow)
+    def wrapper(self, *args, **kwargs):
+        counters = self.stats.begin(name, args[0] if args and isinstance(args[0], str) else None)
+        try:
+            return (yield from flow(self, *args, **kwargs))
+        finally:
+            self.stats.end(counters)
+    return wrapper
@@ -2,12 +2,15 @@
 # Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
 """Various utility functions"""
 
+import json
+import os
+import threading
 from platform import system
 
 # from wrapt import ObjectProxy
 from sys import version_info
 
-__all__ = ['system', 'hexify', 'from_file', 'PY2', 'ENCODING']
+__all__ = ['system', 'hexify', 'from_file', 'cache_dir', 'write_json', 'PY2', 'ENCODING']
 
 PY2 = version_info.major == 2
 
@@ -36,3 +39,28 @@ def from_file(path):
     with open(path, 'rb') as f:
         content = f.read()
     return content
+
+
+def cache_dir():
+    """Returns the folder where state is kept between runs.
+    NODEMCU_UPLOADER_CACHE overrides the default location.
+    """
+    path = os.environ.get('NODEMCU_UPLOADER_CACHE')
+    if not path:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(base, 'nodemcu-uploader')
+    return path
+
+
+def write_json(path, data):
+    """Writes data as json to path so that readers never see half a file.
+    The temporary file is named per process and thread since --fleet saves
+    from several threads at once.
+    """
+    dirpath = os.path.dirname(path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    tmp = '{0}.{1}-{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as fil:
+        json.dump(data, fil, indent=1, sort_keys=True)
+    os.replace(tmp, path)
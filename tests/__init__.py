@@ -15,10 +15,13 @@ def full_suite():
         format='%(asctime)s %(levelname)s %(module)s.%(funcName)s %(message)s')
 
     from .misc import MiscTestCase
+    from .emulator import EmulatorTestCase, LuaEmulatorTestCase
     from . import uploader
     # from .serializer import ResourceTestCase as SerializerTestCase
     # from .utils import UtilsTestCase
 
     miscsuite = unittest.TestLoader().loadTestsFromTestCase(MiscTestCase)
     uploadersuite = unittest.TestLoader().loadTestsFromModule(uploader)
-    return unittest.TestSuite([miscsuite, uploadersuite])
+    emulatorsuite = unittest.TestLoader().loadTestsFromTestCase(EmulatorTestCase)
+    luasuite = unittest.TestLoader().loadTestsFromTestCase(LuaEmulatorTestCase)
+    return unittest.TestSuite([miscsuite, uploadersuite, emulatorsuite, luasuite])
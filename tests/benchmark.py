@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+"""Throughput benchmarks of the transfers against the emulated device.
+
+    python -m tests.benchmark --output results.json
+    python -m tests.benchmark --baseline results.json --threshold 0.1
+
+Every operation runs for each combination of file size, file count and
+baudrate. The emulator sends every byte at the speed of the baudrate and adds
+a fixed latency each way, so the numbers are comparable between machines and
+show the cost of round trips. With --baseline the exit code is 1 if the
+throughput of any case dropped more than the threshold.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from nodemcu_uploader import Uploader, __version__
+from nodemcu_uploader.luacode import RECV_LUA, SEND_LUA
+from nodemcu_uploader.minify import minify
+
+SIZES = [1024, 16384]
+COUNTS = [1, 4]
+BAUDS = [115200, 921600]
+LATENCY = 0.005
+THRESHOLD = 0.1
+
+
+def device_url(name, latency):
+    return 'nodemcu://{0}?latency={1}&throttle=1'.format(name, latency)
+
+
+def connect(name, baud, latency):
+    return Uploader(device_url(name, latency), baud=baud, timeout=30, autobaud_time=0.01)
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def case_key(operation, **params):
+    return '/'.join([operation] + ['{0}={1}'.format(k, params[k]) for k in sorted(params)])
+
+
+def bench_prepare(baud, latency, run):
+    """Installing the helper functions on a device without them"""
+    uploader = connect('prepare-{0}-{1}'.format(baud, run), baud, latency)
+    try:
+        seconds = timed(uploader.prepare)
+    finally:
+        uploader.close()
+    return seconds, len(minify(RECV_LUA + '\n' + SEND_LUA, rename=True))
+
+
+def bench_files(size, count, baud, latency, folder):
+    """The transfers of count files of size bytes, returns {operation: seconds}"""
+    rnd = random.Random(size * count)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, 'f{0}-{1}.bin'.format(size, i))
+        with open(path, 'wb') as f:
+            f.write(bytes(rnd.getrandbits(8) for _ in range(size)))
+        paths.append(path)
+    names = [os.path.basename(path) for path in paths]
+    uploader = connect('files-{0}-{1}-{2}'.format(size, count, baud), baud, latency)
+    try:
+        uploader.prepare()
+        return {
+            'write_file': timed(lambda: [uploader.write_file(path) for path in paths]),
+            'verify_file': timed(lambda: [uploader.verify_file(path, name, 'sha1')
+                                          for path, name in zip(paths, names)]),
+            'download_file': timed(lambda: [uploader.download_file(name) for name in names]),
+            'backup': timed(uploader.backup, os.path.join(folder, 'backup')),
+        }
+    finally:
+        uploader.close()
+
+
+def run(sizes, counts, bauds, latency, repeat):
+    """Runs the whole matrix, the best of repeat runs of every case is kept"""
+    results = {}
+
+    def record(key, seconds, size):
+        best = results.get(key)
+        if best is None or seconds < best['seconds']:
+            results[key] = {'seconds': seconds, 'bytes': size, 'throughput': size / seconds}
+
+    for i in range(repeat):
+        for baud in bauds:
+            seconds, helpers = bench_prepare(baud, latency, i)
+            record(case_key('prepare', baud=baud), seconds, helpers)
+            for size in sizes:
+                for count in counts:
+                    folder = tempfile.mkdtemp()
+                    try:
+                        timings = bench_files(size, count, baud, latency, folder)
+                    finally:
+                        shutil.rmtree(folder)
+                    for operation, seconds in timings.items():
+                        record(case_key(operation, size=size, count=count, baud=baud), seconds, size * count)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the change against baseline. Returns the keys of the cases that regressed"""
+    regressed = []
+    for key in sorted(results):
+        current = results[key]['throughput']
+        before = baseline.get(key, {}).get('throughput')
+        if before is None:
+            print('{0:60s} {1:12.0f} B/s  (new)'.format(key, current))
+            continue
+        change = current / before - 1
+        slower = change < -threshold
+        if slower:
+            regressed.append(key)
+        print('{0:60s} {1:12.0f} B/s {2:+7.1%}{3}'.format(key, current, change, '  REGRESSION' if slower else ''))
+    return regressed
+
+
+def arg_list(value):
+    return [int(item, 0) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Transfer benchmarks against the emulated device',
+                                     prog='python -m tests.benchmark')
+    parser.add_argument('--sizes', type=arg_list, default=SIZES, help='Comma separated file sizes in bytes')
+    parser.add_argument('--counts', type=arg_list, default=COUNTS, help='Comma separated file counts')
+    parser.add_argument('--bauds', type=arg_list, default=BAUDS, help='Comma separated baudrates')
+    parser.add_argument('--latency', type=float, default=LATENCY, help='Latency each way in seconds')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs of every case, the best is kept')
+    parser.add_argument('--output', '-o', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', '-b', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Share of throughput that may be lost before it is a regression')
+    args = parser.parse_args()
+
+    # the bauds learned here must not end up in the user's cache, nor come from it
+    cache = tempfile.mkdtemp()
+    os.environ['NODEMCU_UPLOADER_CACHE'] = cache
+    try:
+        results = run(args.sizes, args.counts, args.bauds, args.latency, args.repeat)
+    finally:
+        shutil.rmtree(cache)
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'latency': args.latency,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('latency') != args.latency:
+            print('baseline was made with latency {0}, not comparable'.format(baseline.get('latency')))
+            sys.exit(2)
+        baseline = baseline['results']
+    regressed = compare(results, baseline, args.threshold)
+    if regressed:
+        print('{0} of {1} cases regressed more than {2:.0%}'.format(len(regressed), len(results), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
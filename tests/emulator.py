@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+# pylint: disable=C0111,R0904
+import asyncio
+import functools
+import hashlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from nodemcu_uploader import Uploader, AsyncUploader
+from nodemcu_uploader import daemon
+from nodemcu_uploader.baudcache import BaudCache
+from nodemcu_uploader.manifest import BackupManifest
+from nodemcu_uploader.emulator import Device, device, serve_pty, lupa
+from nodemcu_uploader.exceptions import DeviceNotFoundException, VerificationError
+from nodemcu_uploader.main import operation_upload, operation_download, daemon_execute, build_parser
+from nodemcu_uploader.query import query_code
+from nodemcu_uploader.compression import worth_compressing
+
+FIXTURES = 'tests/fixtures'
+EMULATOR = 'nodemcu://{0}'
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+class EmulatorTestCase(unittest.TestCase):
+    """The same things as in UploaderTestCase and TestTorture but against the emulator"""
+    uploader = None
+    URL = EMULATOR
+    # what the device says about a call of a function that doesn't exist
+    NOSUCH = "can't run 'nosuch()'"
+
+    @classmethod
+    def setUpClass(cls):
+        # the rates that devices were left at are remembered in the cache
+        cls.cache = tempfile.mkdtemp()
+        cls.environ = os.environ.get('NODEMCU_UPLOADER_CACHE')
+        os.environ['NODEMCU_UPLOADER_CACHE'] = cls.cache
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.environ is None:
+            del os.environ['NODEMCU_UPLOADER_CACHE']
+        else:
+            os.environ['NODEMCU_UPLOADER_CACHE'] = cls.environ
+        shutil.rmtree(cls.cache)
+
+    def setUp(self):
+        # every test, of every class, has a device of its own
+        self.name = '_'.join(self.id().split('.')[-2:])
+        self.url = self.URL.format(self.name)
+        self.uploader = Uploader(self.url, timeout=2, autobaud_time=0.01)
+        self.device = device(self.name)
+
+    def tearDown(self):
+        self.uploader.close()
+
+    def test_upload_and_verify(self):
+        self.assertTrue(self.uploader.prepare())
+        for name in ('big_file.txt', 'signatur.tif', 'testuploadfail.txt'):
+            self.uploader.write_file(os.path.join(FIXTURES, name), verify='raw', window=4)
+            self.uploader.write_file(os.path.join(FIXTURES, name), verify='sha1', compress=True)
+            self.assertEqual(self.device.files[name], fixture(name))
+
+    def test_verify_digest(self):
+        self.uploader.prepare()
+        self.uploader.write_file(os.path.join(FIXTURES, 'signatur.tif'), verify='sha1', compress=True)
+        self.assertFalse([op for op in self.uploader.stats.operations if op.name == 'verify_file'])
+        # without crypto.new_hash the device is asked for the SHA1 afterwards
+        self.device.NEW_HASH = False
+        self.uploader.write_file(os.path.join(FIXTURES, 'signatur.tif'), verify='sha1')
+        self.assertTrue([op for op in self.uploader.stats.operations if op.name == 'verify_file'])
+        self.assertEqual(self.device.files['signatur.tif'], fixture('signatur.tif'))
+
+    def test_backup_incremental(self):
+        self.device.files.update({'a.lua': b'print(1)', 'b.lua': b'print(2)', 'lib/c.lua': b'print(3)'})
+        folder = tempfile.mkdtemp()
+        try:
+            self.assertEqual(self.uploader.backup(folder, True), ['a.lua', 'b.lua', 'lib/c.lua'])
+            self.assertEqual(self.uploader.backup(folder, True), [])
+            self.device.files['b.lua'] = b'print(22)'
+            del self.device.files['a.lua']
+            self.device.files['d.lua'] = b'print(4)'
+            self.assertEqual(self.uploader.backup(folder, True), ['b.lua', 'd.lua'])
+            with open(os.path.join(folder, 'b.lua'), 'rb') as f:
+                self.assertEqual(f.read(), b'print(22)')
+            # a backup that is gone locally is downloaded again
+            os.remove(os.path.join(folder, 'lib', 'c.lua'))
+            self.assertEqual(self.uploader.backup(folder, True), ['lib/c.lua'])
+            manifest = BackupManifest(folder, self.uploader.device_id())
+            self.assertEqual(sorted(manifest.files), ['b.lua', 'd.lua', 'lib/c.lua'])
+            self.assertEqual(list(manifest.deleted), ['a.lua'])
+            downloads = [op for op in self.uploader.stats.operations if op.name == 'download_file']
+            self.assertEqual(len(downloads), 6)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_resume(self):
+        self.uploader.prepare()
+        path = os.path.join(FIXTURES, 'big_file.txt')
+        content = fixture('big_file.txt')
+        # what an interrupted upload leaves behind
+        self.device.files['big_file.txt'] = content[:3000]
+        self.uploader.write_file(path, verify='sha1', resume=True)
+        self.assertEqual(self.device.files['big_file.txt'], content)
+        self.uploader.write_file(path, verify='sha1', resume=True)
+        self.device.files['big_file.txt'] = b'something else'
+        self.uploader.write_file(path, verify='sha1', resume=True)
+        self.assertEqual(self.device.files['big_file.txt'], content)
+        writes = [op.payload for op in self.uploader.stats.operations if op.name == 'write_file']
+        self.assertEqual(writes, [len(content) - 3000, 0, len(content)])
+
+        def downloaded():
+            with open(destination, 'rb') as f:
+                return f.read()
+        folder = tempfile.mkdtemp()
+        try:
+            destination = os.path.join(folder, 'big_file.txt')
+            with open(destination, 'wb') as f:
+                f.write(content[:5000])
+            self.assertEqual(self.uploader.read_file('big_file.txt', destination, resume=True), len(content) - 5000)
+            self.assertEqual(downloaded(), content)
+            with open(destination, 'wb') as f:
+                f.write(b'something else')
+            self.assertEqual(self.uploader.read_file('big_file.txt', destination, resume=True), len(content))
+            self.assertEqual(downloaded(), content)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_download_fails(self):
+        self.uploader.prepare()
+        folder = tempfile.mkdtemp()
+        try:
+            destination = os.path.join(folder, 'keep.txt')
+            with open(destination, 'wb') as f:
+                f.write(b'keep me')
+            self.uploader.set_timeout(1)
+            with self.assertRaises(Exception):
+                self.uploader.read_file('keep.txt', destination)
+            with open(destination, 'rb') as f:
+                self.assertEqual(f.read(), b'keep me')
+            self.assertEqual(os.listdir(folder), ['keep.txt'])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_prepare_once(self):
+        self.assertTrue(self.uploader.prepare())
+        self.assertEqual(self.device.proto, 6)
+        self.assertTrue(self.uploader.prepare())
+
+    def test_file_list(self):
+        self.device.files.update({'init.lua': b'print(1)', 'data.txt': b'abc'})
+        self.assertEqual(sorted(self.uploader.file_list()), [['data.txt', '3'], ['init.lua', '8']])
+        self.assertEqual(self.uploader.file_hashes()['data.txt'][0], 3)
+        # printed text would split these names
+        self.device.files['a\tb\r\nc'] = b'abc'
+        self.assertEqual(self.uploader.file_hashes()['a\tb\r\nc'], (3, hashlib.sha1(b'abc').hexdigest()))
+        del self.device.files['a\tb\r\nc']
+        self.assertEqual(self.uploader.device_id(), '{0}-{1}'.format(self.device.CHIP_ID, self.device.FLASH_ID))
+        self.uploader.file_remove('data.txt')
+        self.assertEqual(list(self.device.files), ['init.lua'])
+        self.uploader.file_remove_all()
+        self.assertEqual(self.device.files, {})
+
+    def test_node_heap(self):
+        self.assertEqual(self.uploader.node_heap(), Device.HEAP)
+
+    def test_node_info(self):
+        result = self.uploader.node_info()
+        self.assertIn('chip_id', result)
+        self.assertNotIn('stdin', result)
+
+    def test_upload_compile_download(self):
+        self.uploader.prepare()
+        dests = operation_upload(self.uploader, os.path.join(FIXTURES, '*.lua'), 'sha1', True, False, False)
+        self.assertEqual(sorted(self.device.files), sorted(os.path.splitext(d)[0] + '.lc' for d in dests))
+        folder = tempfile.mkdtemp()
+        try:
+            self.uploader.backup(folder)
+            self.assertEqual(sorted(os.listdir(os.path.join(folder, FIXTURES))),
+                             sorted(os.path.basename(name) for name in self.device.files))
+            lc = sorted(self.device.files)[0]
+            operation_download(self.uploader, [lc + ':copy.lc'], dest=folder)
+            with open(os.path.join(folder, 'copy.lc'), 'rb') as f:
+                self.assertEqual(f.read()[4:], fixture(os.path.basename(lc)[:-3] + '.lua'))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_upload_fails_remote(self):
+        self.uploader.prepare()
+        folder = tempfile.mkdtemp()
+        try:
+            for name, code in (('a.lua', 'print("a")'), ('b.lua', 'nosuch()')):
+                with open(os.path.join(folder, name), 'w') as f:
+                    f.write(code)
+            with self.assertRaises(Exception) as ctx:
+                operation_upload(self.uploader, [os.path.join(folder, 'a.lua') + ':a.lua',
+                                                 os.path.join(folder, 'b.lua') + ':b.lua'],
+                                 'raw', False, True, False)
+            self.assertIn('Executing b.lua', str(ctx.exception))
+            self.assertEqual(sorted(self.device.files), ['a.lua', 'b.lua'])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_sync_after_failed_verify(self):
+        self.uploader.prepare()
+        self.uploader.load_manifest()
+        path = os.path.join(FIXTURES, 'small_file.txt') + ':small_file.txt'
+        good = fixture('small_file.txt')
+
+        class Corrupting(dict):
+            """Files of a device that gets the whole of small_file.txt wrong, at the same size"""
+            def __setitem__(self, name, content):
+                super(Corrupting, self).__setitem__(name, content.swapcase() if content == good else content)
+        self.device.files = Corrupting()
+        with self.assertRaises(VerificationError):
+            operation_upload(self.uploader, [path], 'raw', False, False, False, sync=True)
+        self.assertEqual(len(self.device.files['small_file.txt']), len(good))
+        self.assertFalse(self.uploader.manifest.known('small_file.txt'))
+        self.device.files = dict(self.device.files)
+        operation_upload(self.uploader, [path], 'raw', False, False, False, sync=True)
+        self.assertEqual(self.device.files['small_file.txt'], good)
+        self.assertTrue(self.uploader.manifest.known('small_file.txt'))
+
+    def test_query(self):
+        self.device.files.update({'init.lua': b'print(1)', 'odd\tname\r\n.txt': b'abc'})
+        fields = ('files', 'heap', 'hw', 'sw_version', 'build_config')
+        state = self.uploader.query(*fields)
+        self.assertEqual(state['files'], {'init.lua': 8, 'odd\tname\r\n.txt': 3})
+        self.assertEqual(state['heap'], Device.HEAP)
+        self.assertEqual(state['hw']['chip_id'], Device.CHIP_ID)
+        self.assertIs(state['build_config']['ssl'], False)
+        # the same with sjson
+        self.device.INFO = dict(Device.INFO, build_config=[('modules', 'file,node,sjson')])
+        self.assertEqual(self.uploader.query(*fields), dict(state, build_config={'modules': 'file,node,sjson'}))
+        self.uploader.node_info()
+        query, = [op for op in self.uploader.stats.operations if op.name == 'node_info']
+        self.assertEqual(query.waits['expect'].count, 2)
+
+    def test_batch(self):
+        self.uploader.prepare()
+        self.device.files.update({'a.lua': b'print("a")', 'b.lua': b'print("b")'})
+        with self.uploader.batch() as batch:
+            for name in ('a', 'b', 'c'):
+                batch.file_compile(name + '.lua')
+                batch.file_remove(name + '.lua')
+                batch.file_do(name + '.lc')
+        self.assertEqual(sorted(self.device.files), ['a.lc', 'b.lc'])
+        self.assertEqual([r.output for r in batch.results[:6]], ['', '', 'a', '', '', 'b'])
+        errors = [r.error for r in batch.results[6:]]
+        self.assertIsNone(errors[1])
+        self.assertTrue(errors[0].endswith(': cannot open c.lua'))
+        self.assertTrue(errors[2].endswith(': cannot open c.lc'))
+        run, = [op for op in self.uploader.stats.operations if op.name == 'run_batch']
+        self.assertEqual(run.waits['expect'].count, 2)
+
+    def test_exec(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'setup.lua')
+            with open(path, 'wb') as f:
+                f.write(b'print("one")\r\n' * 50 + b'print(node.heap())\n')
+            self.uploader.exec_file(path)
+            lines, = [op for op in self.uploader.stats.operations if op.name == 'exec_file']
+            result = self.uploader.exec_file(path, block=True)
+            block = [op for op in self.uploader.stats.operations if op.name == 'exec_file'][1]
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(result.output.splitlines(), ['one'] * 50 + [str(Device.HEAP)])
+        self.assertIsNone(result.error)
+        self.assertEqual(self.device.files, {})
+        self.assertGreater(lines.waits['expect'].count, 50)
+        self.assertLess(block.waits['expect'].count, 10)
+        result = self.uploader.write_lines('print("two")\nnosuch()', block=True)
+        self.assertEqual(result.output, 'two')
+        self.assertIn(self.NOSUCH, result.error)
+
+    def test_baud(self):
+        self.uploader.close()
+        self.uploader = Uploader(self.url, baud=921600, timeout=2, autobaud_time=0.01)
+        self.assertEqual(self.device.baud, 921600)
+        self.assertEqual(self.uploader.node_heap(), Device.HEAP)
+        self.uploader.close()
+        self.assertEqual(self.device.baud, Uploader.START_BAUD)
+        self.uploader = Uploader(self.url, timeout=2, autobaud_time=0.01)
+
+    def test_auto_baud(self):
+        self.device.max_baud = 460800
+        folder = tempfile.mkdtemp()
+        try:
+            cache = BaudCache(os.path.join(folder, 'bauds.json'))
+            self.uploader.baud = self.uploader.auto_baud(cache=cache)
+            self.assertEqual(self.uploader.baud, 460800)
+            self.assertEqual(self.device.baud, 460800)
+            self.assertEqual(self.uploader.node_heap(), Device.HEAP)
+            self.assertEqual(list(BaudCache(cache.path).bauds.values()), [460800])
+            self.uploader.close()
+            # the remembered rate no longer works, it starts over
+            self.device.max_baud = 230400
+            self.uploader = Uploader(self.url, timeout=2, autobaud_time=0.01)
+            self.uploader.baud = self.uploader.auto_baud(cache=cache)
+            self.assertEqual(self.uploader.baud, 230400)
+            self.assertEqual(self.uploader.node_heap(), Device.HEAP)
+            self.assertEqual(list(BaudCache(cache.path).bauds.values()), [230400])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_fast_connect(self):
+        self.uploader.prepare()
+        self.uploader.close()
+        start = time.time()
+        self.uploader = Uploader(self.url, timeout=2, autobaud_time=2)
+        self.assertLess(time.time() - start, 1)
+        # the probe found the helpers
+        self.uploader.prepare()
+        prepare, = [op for op in self.uploader.stats.operations if op.name == 'prepare']
+        self.assertEqual(prepare.written, 0)
+        # left at a higher rate without close(), like after a crash
+        self.uploader.close()
+        self.uploader = Uploader(self.url, baud=921600, timeout=2, autobaud_time=0.01)
+        self.uploader._port.close()
+        start = time.time()
+        self.uploader = Uploader(self.url, baud=921600, timeout=2, autobaud_time=2)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.device.baud, 921600)
+        self.uploader.close()
+        self.assertEqual(self.device.baud, Uploader.START_BAUD)
+        start = time.time()
+        self.uploader = Uploader(self.url, timeout=2, autobaud_time=2)
+        self.assertLess(time.time() - start, 1)
+
+    def test_wrong_baud(self):
+        self.device.baud = 9600
+        self.assertRaises(DeviceNotFoundException, Uploader, self.url, timeout=1,
+                          autobaud_time=0.01)
+
+    def test_pty(self):
+        path, stop = serve_pty(self.device)
+        try:
+            uploader = Uploader(path, timeout=2, autobaud_time=0.01)
+            self.assertTrue(uploader.prepare())
+            uploader.write_file(os.path.join(FIXTURES, 'small_file.txt'), verify='sha1')
+            uploader.close()
+        finally:
+            stop()
+        self.assertEqual(self.device.files['small_file.txt'], fixture('small_file.txt'))
+
+    @staticmethod
+    def fail_open():
+        raise DeviceNotFoundException('gone')
+
+    @unittest.skipUnless(daemon.supported(), 'needs Unix sockets')
+    def test_daemon(self):
+        self.uploader.close()
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'daemon.sock')
+        session = daemon.Session(self.url, autobaud_time=0.01)
+        session.open()
+        execute = functools.partial(daemon_execute, settings=build_parser().parse_args(['daemon', 'run']))
+        thread = threading.Thread(target=daemon.serve, args=(session, execute, path))
+        thread.start()
+        try:
+            while not os.path.exists(path):
+                thread.join(0.01)
+            upload = {'argv': ['upload', 'small_file.txt'], 'cwd': FIXTURES}
+            self.assertEqual(daemon.request(path, upload), 0)
+            self.assertEqual(self.device.files['small_file.txt'], fixture('small_file.txt'))
+            # it syncs again after a restart
+            self.assertEqual(daemon.request(path, {'argv': ['node', 'restart']}), 0)
+            missing = {'argv': ['--timeout', '1', 'download', 'missing.txt'], 'cwd': folder}
+            self.assertEqual(daemon.request(path, missing), 1)
+            self.assertEqual(daemon.request(path, {'argv': ['file', 'remove', 'small_file.txt']}), 0)
+            # the port stays at the daemon's baudrate, the client is told so
+            with self.assertLogs('nodemcu_uploader.daemon', 'WARNING') as logs:
+                self.assertEqual(daemon.request(path, {'argv': ['--baud', '921600', 'node', 'heap']}), 0)
+            self.assertIn('--baud 921600 is ignored', logs.output[0])
+            self.assertEqual(self.device.files, {})
+            # a live daemon keeps its socket
+            self.assertFalse(daemon.serve(session, daemon_execute, path))
+            # it keeps serving when the device can't be reached after a restart
+            session.open = self.fail_open
+            self.assertEqual(daemon.request(path, {'argv': ['node', 'restart']}), 1)
+            out = io.StringIO()
+            self.assertEqual(daemon.request(path, {'status': True}, out=out), 0)
+            self.assertIn('not connected', out.getvalue())
+            del session.open
+            self.assertEqual(daemon.request(path, {'argv': ['node', 'heap']}), 0)
+        finally:
+            self.assertTrue(daemon.stop(path))
+            thread.join()
+            session.close()
+            shutil.rmtree(folder)
+        self.assertIsNone(daemon.request(path, {'status': True}))
+        self.uploader = Uploader(self.url, timeout=2, autobaud_time=0.01)
+
+    def test_async(self):
+        async def flash(name):
+            uploader = await AsyncUploader.connect(self.URL.format(name), timeout=2, autobaud_time=0.01)
+            try:
+                await uploader.prepare()
+                await uploader.write_file(os.path.join(FIXTURES, 'big_file.txt'), verify='raw', window=4)
+                return await uploader.file_list()
+            finally:
+                await uploader.close()
+
+        async def flash_all():
+            return await asyncio.gather(*[flash('{0}{1}'.format(self.name, i)) for i in range(4)])
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(flash_all())
+        loop.close()
+        self.assertEqual(results, [[['big_file.txt', '5511']]] * 4)
+
+    def test_stats(self):
+        self.uploader.prepare()
+        self.uploader.write_file(os.path.join(FIXTURES, 'big_file.txt'), verify='sha1', window=2)
+        write, = [op for op in self.uploader.stats.operations if op.name == 'write_file']
+        self.assertEqual(write.payload, 5511)
+        self.assertEqual(write.frames, 3)
+        self.assertGreater(write.written, write.payload)
+        # one for the name and one per block
+        self.assertEqual(write.waits['ack'].count, 4)
+        self.assertEqual(write.timeouts, 0)
+        # the device hashed it while writing
+        self.assertEqual(write.waits['digest'].count, 1)
+        self.uploader.write_file(os.path.join(FIXTURES, 'big_file.txt'), verify='raw', window=2)
+        write = [op for op in self.uploader.stats.operations if op.name == 'write_file'][1]
+        # the verify is part of the write
+        verify, = [op for op in self.uploader.stats.operations if op.name == 'verify_file']
+        self.assertLess(verify.written, write.written)
+        total = self.uploader.stats.to_dict()['total']
+        self.assertGreaterEqual(total['written'], write.written)
+
+    def test_progress(self):
+        self.uploader.prepare()
+        events = []
+        self.uploader.listeners.append(events.append)
+        self.uploader.write_file(os.path.join(FIXTURES, 'big_file.txt'), window=2)
+        self.assertEqual([(e.event, e.done) for e in events],
+                         [('start', 0), ('frame', 4096), ('frame', 5511), ('frame', 5511), ('end', 5511)])
+        self.assertTrue(all(e.total == 5511 and e.operation == 'write_file' for e in events))
+        del events[:]
+        self.uploader.download_file('big_file.txt')
+        self.assertEqual([(e.event, e.done, e.total) for e in events],
+                         [('start', 0, None), ('frame', 4096, None), ('frame', 5511, None), ('end', 5511, 5511)])
+
+
+@unittest.skipIf(lupa is None, 'needs lupa')
+class LuaEmulatorTestCase(EmulatorTestCase):
+    """The same against the emulator that runs the Lua code of luacode"""
+    URL = EMULATOR + '?lua=1'
+    NOSUCH = "attempt to call global 'nosuch' (a nil value)"
+
+    def test_receive_in_pieces(self):
+        self.uploader.prepare()
+        content = fixture('big_file.txt')
+        size = self.uploader.block_size
+        callbacks = self.device.uart_callbacks
+        self.uploader.write_file(os.path.join(FIXTURES, 'big_file.txt'), window=4)
+        self.assertEqual(self.device.files['big_file.txt'], content)
+        # the name, then for every block the header and pieces of at most 255 bytes
+        blocks = [len(content[pos:pos + size]) for pos in range(0, len(content), size)] + [0]
+        self.assertEqual(self.device.uart_callbacks - callbacks, 1 + sum(1 + -(-length // 255) for length in blocks))
+
+    def test_load_chunk_in_pieces(self):
+        callbacks = self.device.uart_callbacks
+        self.assertEqual(self.uploader.query('heap', 'hw')['heap'], Device.HEAP)
+        # pieces of at most 255 bytes, not a callback per character
+        size = len(query_code(['heap', 'hw']))
+        self.assertEqual(self.device.uart_callbacks - callbacks, -(-size // 255))
+
+    def test_inflate(self):
+        self.uploader.prepare()
+        rnd = random.Random(8)
+        words = [bytes(rnd.choice(b'abcdefgh') for _ in range(rnd.randint(1, 12))) for _ in range(40)]
+        # copies from near and far back and ones that overlap what they produce
+        content = b' '.join(rnd.choice(words) for _ in range(3000)) + b'z' * 300
+        self.assertTrue(worth_compressing(content))
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'words.txt')
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.uploader.write_file(path, verify='raw', compress=True)
+            self.assertEqual(self.device.files['words.txt'], content)
+        finally:
+            shutil.rmtree(folder)
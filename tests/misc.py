@@ -1,11 +1,26 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2015-2019 Peter Magnusson <peter@kmpm.se>
+import io
 import unittest
-from nodemcu_uploader.serialutils import default_port
+import serial
+from nodemcu_uploader.serialutils import default_port, BufferedReader, AsyncTransport
 from nodemcu_uploader import __version__
 import os
+import asyncio
+import shutil
+import tempfile
 
-from nodemcu_uploader import validate, exceptions
+from nodemcu_uploader import validate, exceptions, luacode
+from nodemcu_uploader.emulator import lupa
+from nodemcu_uploader.core import block_size_for_heap, frame, acked_count, split_blocks, format_file_hashes, \
+    UploaderCore, Write, ReadUntil
+from nodemcu_uploader.manifest import Manifest, BackupManifest
+from nodemcu_uploader.minify import minify
+from nodemcu_uploader.fleet import fleet_ports, device_name, run_fleet
+from nodemcu_uploader.compression import compress_block, decompress_block, worth_compressing
+from nodemcu_uploader.batch import Batch, BatchResult, parse_batch
+from nodemcu_uploader.query import query_code, parse_query, encode, decode
+from nodemcu_uploader.progress import Progress, ProgressBar
 
 
 class MiscTestCase(unittest.TestCase):
@@ -32,3 +47,205 @@ class MiscTestCase(unittest.TestCase):
 
         self.assertRaises(exceptions.ValidationException, (lambda: v("test/something/maximum/leng.jpeg")))
         self.assertRaises(exceptions.ValidationException, (lambda: v("")))
+
+    def test_block_size_for_heap(self):
+        self.assertEqual(block_size_for_heap(0), 128)
+        self.assertEqual(block_size_for_heap(20000), 2048)
+        self.assertEqual(block_size_for_heap(40000), 4096)
+        self.assertEqual(block_size_for_heap(1000000), 4096)
+
+    def test_buffered_reader(self):
+        port = serial.serial_for_url('loop://', timeout=1)
+        reader = BufferedReader(port)
+        port.write(b'print(1)\r\n1\r\n> \x06\x00rest')
+        self.assertEqual(reader.read_until(b'> ', 1), b'print(1)\r\n1\r\n> ')
+        self.assertEqual(reader.read(2, 1), b'\x06\x00')
+        # nothing more arrives so only what is there
+        self.assertEqual(reader.read(10, 0.1), b'rest')
+        self.assertEqual(reader.read_until(b'> ', 0.1), b'')
+        port.write(b'garbage')
+        reader.read(1, 1)
+        reader.clear()
+        port.reset_input_buffer()
+        self.assertEqual(len(reader), 0)
+        port.close()
+
+    def test_manifest(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'dev.json')
+            manifest = Manifest('1-2', path)
+            self.assertEqual(manifest.files, {})
+            manifest.update('a.lua', 10, 'aa')
+            manifest.update('b.lua', 20, 'bb')
+            manifest.update('c.lua', 30, 'cc')
+            manifest.save()
+
+            manifest = Manifest('1-2', path)
+            self.assertEqual(manifest.get('a.lua'), (10, 'aa'))
+            # b changed size, c is gone and d is new
+            manifest.validate({'a.lua': 10, 'b.lua': 21, 'd.lua': 40})
+            self.assertEqual(manifest.get('a.lua'), (10, 'aa'))
+            self.assertEqual(manifest.get('b.lua'), (21, None))
+            self.assertIsNone(manifest.get('c.lua'))
+            self.assertTrue(manifest.known('a.lua'))
+            self.assertTrue(manifest.known('c.lua'))
+            self.assertFalse(manifest.known('d.lua'))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_backup_manifest(self):
+        folder = tempfile.mkdtemp()
+        try:
+            manifest = BackupManifest(folder, '1-2')
+            manifest.update('a.lua', 10, 'aa')
+            manifest.update('b.lua', 20, 'bb')
+            manifest.remove('a.lua')
+            manifest.save()
+
+            manifest = BackupManifest(folder, '1-2')
+            self.assertEqual(manifest.files, {'b.lua': (20, 'bb')})
+            self.assertEqual(manifest.deleted['a.lua'][:2], (10, 'aa'))
+            # back again
+            manifest.update('a.lua', 11, 'ab')
+            self.assertEqual(manifest.deleted, {})
+            manifest.save()
+            # the folder has the backup of another device
+            manifest = BackupManifest(folder, '3-4')
+            self.assertEqual(manifest.files, {})
+        finally:
+            shutil.rmtree(folder)
+
+    def test_compression(self):
+        for name in ('big_file.txt', 'webserver.lua', 'testuploadfail.txt'):
+            with open(os.path.join('tests', 'fixtures', name), 'rb') as fil:
+                content = fil.read()
+            self.assertTrue(worth_compressing(content))
+            block = content[:4096]
+            packed = compress_block(block)
+            self.assertLess(len(packed), len(block))
+            self.assertEqual(decompress_block(packed), block)
+        # overlapping copies
+        self.assertEqual(decompress_block(compress_block(b'ab' * 500)), b'ab' * 500)
+        self.assertEqual(decompress_block(compress_block(b'')), b'')
+        self.assertFalse(worth_compressing(os.urandom(1000)))
+
+    def test_minify(self):
+        self.assertEqual(minify('local a = 1 -- one\n--[[ long\ncomment ]]\nprint( a , "x  y" )'),
+                         'local a=1 print(a,"x  y")')
+        # tokens that would run together
+        self.assertEqual(minify('a = b - -c .. 1 .. d'), 'a=b- -c..1 ..d')
+        self.assertEqual(minify('s = [==[ -- kept ]==]'), 's=[==[ -- kept ]==]')
+        self.assertEqual(minify('print(1)\nprint(2)', max_line=8), 'print(1)\nprint(2)')
+
+    def test_minify_rename(self):
+        # globals, fields, table keys and the implicit self keep their names
+        self.assertEqual(
+            minify('local print = print local t = {value = 1}\n'
+                   'function t:get(value) return self.value + value end', rename=True),
+            'local print=print local a={value=1}function a:get(b)return self.value+b end')
+        self.assertEqual(minify('local count = 0 count = count + 1', rename=True, keep=['count']),
+                         'local count=0 count=count+1')
+        # shadowing
+        self.assertEqual(minify('local x = 1 do local x = x + 1 end', rename=True),
+                         'local a=1 do local b=a+1 end')
+
+    def test_fleet(self):
+        self.assertEqual(fleet_ports('/dev/ttyUSB0, /dev/ttyUSB1,'), ['/dev/ttyUSB0', '/dev/ttyUSB1'])
+        self.assertEqual(device_name('/dev/ttyUSB0'), 'ttyUSB0')
+        self.assertEqual(device_name('COM3'), 'COM3')
+        self.assertEqual(device_name('\\\\.\\COM10'), 'COM10')
+        # a port that can't be opened fails without stopping the others
+        results = run_fleet(['/dev/nonexistent0', '/dev/nonexistent1'], lambda uploader, port: None)
+        self.assertEqual([r.port for r in results], ['/dev/nonexistent0', '/dev/nonexistent1'])
+        self.assertFalse(any(r.ok for r in results))
+
+    def test_protocol(self):
+        self.assertEqual(frame(3, b'ab'), b'\x01\x03\x00\x02ab')
+        self.assertEqual(frame(255, b'', True), b'\x02\xff\x00\x00')
+        # cumulative acks, also across the wrap of the sequence number
+        self.assertEqual(acked_count(2, 0, 4), 3)
+        self.assertEqual(acked_count(1, 254, 258), 4)
+        self.assertEqual(acked_count(5, 0, 4), 0)
+        self.assertEqual(acked_count(None, 0, 4), 0)
+        blocks, compressed = split_blocks(b'x' * 300, 128)
+        self.assertEqual([len(b) for b in blocks], [128, 128, 44, 0])
+        self.assertEqual(compressed, [False] * 4)
+        self.assertEqual(format_file_hashes({'init.lua': {'size': 12, 'sha1': 'a' * 40}}),
+                         {'init.lua': (12, 'a' * 40)})
+
+    def test_batch(self):
+        batch = Batch().file_remove('a.lc').file_do('a.lc').code('print(1)')
+        self.assertEqual(len(batch), 3)
+        self.assertEqual([len(group) for group in batch.split(1)], [1, 1, 1])
+        self.assertEqual([len(group) for group in batch.split(4096)], [3])
+        self.assertEqual(parse_batch('\x05\r\nhi\r\nthere\x05\r\nstdin:1: oops\r\n', 3),
+                         [BatchResult('', None), BatchResult('hi\r\nthere', None),
+                          BatchResult('', 'stdin:1: oops')])
+        self.assertEqual(parse_batch('out\r\n\x15stdin:1: oops\r\n', 2),
+                         [BatchResult('out', 'stdin:1: oops'), BatchResult('', 'not run')])
+
+    def test_query(self):
+        self.assertIn("heap=node.heap(),hw=node.info('hw')", query_code(['heap', 'hw']))
+        self.assertRaises(ValueError, query_code, ['nothing'])
+        state = {'files': {'a:b.lua': 12, 'e': 0}, 'heap': 40000, 'hw': {'flash': 1.5, 'ssl': True}, 'empty': {}}
+        self.assertEqual(encode({'ssl': True, 'n': 12}), 'ts3:sslb4:trues1:nn2:12e')
+        self.assertEqual(decode(encode(state)), state)
+        self.assertEqual(parse_query('x\r\n\x02' + encode(state) + '\x03\r\n'), state)
+        self.assertEqual(parse_query('\x02{"files":[],"heap":40000}\x03\r\n'), {'files': {}, 'heap': 40000})
+        self.assertRaises(exceptions.BadResponseException, parse_query, 'stdin:1: oops\r\n')
+        self.assertRaises(exceptions.BadResponseException, parse_query, '\x02ts3:ssl\x03')
+
+    @unittest.skipIf(lupa is None, 'needs lupa')
+    def test_luacode(self):
+        templates = {'LOAD_CHUNK': {'size': 1}, 'PRINT_FILE': {'filename': 'a.lua'},
+                     'QUERY': {'fields': 'heap=node.heap()'}, 'BATCH_STATEMENT': {'code': 'x=1'},
+                     'UART_SETUP': {'baud': 115200}, 'BAUD_TRIAL': {'time': 1, 'fallback': 1, 'baud': 1}}
+        loadstring = lupa.LuaRuntime().globals().loadstring
+        for name, code in vars(luacode).items():
+            # CHUNK_DONE is what the device prints
+            if name.isupper() and isinstance(code, str) and name != 'CHUNK_DONE':
+                loaded = loadstring(code.format(**templates[name]) if name in templates else code)
+                self.assertNotIsInstance(loaded, tuple, name)
+
+    def test_progress_bar(self):
+        stream = io.StringIO()
+        bar = ProgressBar(stream)
+        bar.INTERVAL = 0
+        # resumed at 6000 of 10000 bytes, 2000 more moved in 2 seconds
+        bar(Progress('start', 'write_file', 'a.lua', 6000, 10000, 0))
+        bar(Progress('frame', 'write_file', 'a.lua', 8000, 10000, 2))
+        self.assertIn('ETA 2s', stream.getvalue())
+        self.assertIn('1000 B/s', stream.getvalue())
+
+    def test_async_transport(self):
+        async def run():
+            port = serial.serial_for_url('loop://', timeout=0)
+            transport = AsyncTransport(port)
+            await transport.write(b'hello\r\n> world')
+            self.assertEqual(await transport.read_until(b'> ', 1), b'hello\r\n> ')
+            self.assertEqual(await transport.read(3, 1), b'wor')
+            self.assertEqual(await transport.read(10, 0.1), b'ld')
+            transport.close()
+            port.close()
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+
+    def test_core_flow(self):
+        # a flow only yields what it needs done, no port is involved
+        core = UploaderCore('test://', 115200, 115200, 2, 0.01, 1)
+        flow = core._file_do('init.lua')
+        self.assertEqual(next(flow), Write(b'dofile("init.lua")\n'))
+        self.assertEqual(flow.send(None), ReadUntil(b'> ', 2))
+        with self.assertRaises(StopIteration) as stop:
+            flow.send(b'dofile("init.lua")\r\nhello\r\n> ')
+        self.assertEqual(stop.exception.value, 'dofile("init.lua")\r\nhello\r\n> ')
+        self.assertEqual([op.name for op in core.stats.operations], ['file_do'])
+
+        flow = core._file_list()
+        next(flow)
+        # a timeout of the port is raised in the flow where it waited
+        with self.assertRaises(exceptions.CommunicationTimeout):
+            flow.throw(exceptions.CommunicationTimeout('Timeout waiting for data', b''))
+        self.assertEqual([op.name for op in core.stats.operations], ['file_do', 'query', 'file_list'])